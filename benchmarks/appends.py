@@ -0,0 +1,58 @@
+"""
+Append benchmark, activity-log like traffic.
+
+Appends small pieces to a single key through CacheInterface and reports how many appends per
+second are done, once with the value extended in place and once with the whole value rebuilt on
+every append.
+
+Usage: python benchmarks/appends.py [appends] [piece_size]
+"""
+import sys
+import timeit
+
+from toycache.cache import Cache
+from toycache.cache_interface import CacheInterface, CacheProtocolCommand
+
+
+class CopyingCache(Cache):
+    """
+    Cache rebuilding the whole value on every append.
+    """
+    def extends_in_place(self, item):
+        return False
+
+
+def run(cache, appends, piece_size):
+    cache_interface = CacheInterface(cache)
+    cache.set("log", "", 0)
+
+    piece = "x" * (piece_size - 1) + "\n"
+    command = CacheProtocolCommand.process_command(
+        "append log 0 0 {size}".format(size=piece_size)
+    )
+    command.data = piece
+
+    timer = timeit.default_timer
+    started_at = timer()
+    for _ in range(appends):
+        cache_interface.execute(command)
+    elapsed = timer() - started_at
+
+    assert len(cache.get("log")) == appends * piece_size
+
+    return elapsed
+
+
+def main():
+    appends = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    piece_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    for name, cache in [("copying", CopyingCache()), ("in place", Cache())]:
+        elapsed = run(cache, appends, piece_size)
+        print("{name:10} {appends} appends of {size} bytes in {elapsed:8.3f}s "
+              "({rate:10.0f} appends/s)".format(name=name, appends=appends, size=piece_size,
+                                               elapsed=elapsed, rate=appends / elapsed))
+
+
+if __name__ == "__main__":
+    main()
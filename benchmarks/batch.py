@@ -0,0 +1,47 @@
+"""
+Batch API benchmark.
+
+Gets keys from the cache used in-process, in batches of 1, 10, 100 and 1000 keys, once with `get`
+called for each key and once with `get_many`, and reports how many keys per second are read.
+
+Usage: python benchmarks/batch.py [keys]
+"""
+import sys
+import timeit
+
+from toycache.cache import Cache
+
+
+def run(cache, batch, keys, many):
+    batches = [keys[i:i + batch] for i in range(0, len(keys), batch)]
+
+    timer = timeit.default_timer
+    started_at = timer()
+
+    if many:
+        for batch_keys in batches:
+            cache.get_many(batch_keys)
+    else:
+        for batch_keys in batches:
+            dict((key, cache.get(key)) for key in batch_keys)
+
+    return timer() - started_at
+
+
+def main():
+    key_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    cache = Cache(max_items=key_count)
+    keys = ["key:{i}".format(i=i) for i in range(key_count)]
+    cache.set_many(dict((key, "value") for key in keys), 0)
+
+    for batch in [1, 10, 100, 1000]:
+        single = run(cache, batch, keys, many=False)
+        many = run(cache, batch, keys, many=True)
+        print("batch {batch:5}  get {get:10.0f} keys/s  get_many {many:10.0f} keys/s".format(
+            batch=batch, get=key_count / single, many=key_count / many
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Counter benchmark, rate-limiter like traffic.
+
+Runs a mix of `incr` and `get` commands (3 increments per read) over the given number of
+counters through CacheInterface. Compares counters stored as numbers (CounterValue) with
+the previous approach of parsing the stored string on every increment.
+
+Usage: python benchmarks/counters.py [counters] [operations]
+"""
+import sys
+import timeit
+
+from toycache.cache import Cache, ChunkedValue
+from toycache.cache_interface import CacheInterface, CacheProtocolCommand
+
+
+class StringCounterCache(Cache):
+    """
+    Cache parsing and formatting the counter on every update.
+    """
+    def incr(self, key, increment):
+        item = self.get_cached_item(key)
+
+        if item is None:
+            return None
+
+        self._cache[key].value = str(int(ChunkedValue.flatten(item.value)) + int(increment))
+
+        return self._cache[key].value
+
+
+def run(cache, counters, operations):
+    cache_interface = CacheInterface(cache)
+
+    for i in range(counters):
+        cache.set("ratelimit:{i}".format(i=i), "0", 0)
+
+    commands = []
+    for i in range(operations):
+        key = "ratelimit:{i}".format(i=i % counters)
+        if i % 4 == 3:
+            commands.append(CacheProtocolCommand.process_command("get " + key))
+        else:
+            commands.append(CacheProtocolCommand.process_command("incr " + key + " 1"))
+
+    timer = timeit.default_timer
+    started_at = timer()
+    for command in commands:
+        cache_interface.execute(command)
+
+    return timer() - started_at
+
+
+def main():
+    counters = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 400000
+
+    for name, cache in [("string", StringCounterCache(counters)), ("native", Cache(counters))]:
+        elapsed = run(cache, counters, operations)
+        print("{name:8} {ops:10.0f} ops/s".format(name=name, ops=operations / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Latency of gets during flush_all.
+
+The cache is filled with the given number of items and gets arrive at a fixed rate, latency of a
+get is measured from its arrival. Everything runs on a single thread like in the reactor, so gets
+arriving while the cache is being flushed wait for the flush (or for a reclaim slice) to finish.
+Compares clearing the whole cache at once (the old flush_all) with the O(1) flush followed by
+incremental reclaim.
+
+Usage: python benchmarks/flush_latency.py [items] [gets] [gets_per_second]
+"""
+import sys
+import timeit
+
+from toycache.cache import Cache
+
+
+def run(mode, items, gets, rate, reclaim_batch=100, reclaim_every=50):
+    cache = Cache(max_items=items)
+    for i in range(items):
+        cache.set("key:{i}".format(i=i), "value", 0)
+
+    timer = timeit.default_timer
+    latencies = []
+    flush_at = gets // 10
+    started_at = timer()
+
+    for i in range(gets):
+        arrived_at = started_at + float(i) / rate
+        while timer() < arrived_at:
+            pass
+
+        if i == flush_at:
+            if mode == "clear":
+                cache._cache.clear()
+            else:
+                cache.flush_all()
+
+        if (mode == "incremental") and (i % reclaim_every == 0):
+            cache.reclaim(reclaim_batch)
+
+        cache.get("key:{i}".format(i=i % items))
+        latencies.append(timer() - arrived_at)
+
+    return sorted(latencies)
+
+
+def percentile(latencies, p):
+    return latencies[min(int(len(latencies) * p / 100.0), len(latencies) - 1)]
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    gets = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    rate = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+
+    for mode in ["clear", "incremental"]:
+        latencies = run(mode, items, gets, rate)
+        print("{mode:12} p50 {p50:8.1f}us  p99 {p99:8.1f}us  p99.99 {p9999:10.1f}us  max {max:10.1f}us".format(
+            mode=mode,
+            p50=percentile(latencies, 50) * 1e6,
+            p99=percentile(latencies, 99) * 1e6,
+            p9999=percentile(latencies, 99.99) * 1e6,
+            max=latencies[-1] * 1e6
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Large value throughput benchmark.
+
+Stores a value of the given size and measures how many `get` responses for it per second the
+protocol writes to a transport (which discards the data), once with the value stored in chunks
+and streamed, once with chunking disabled (whole response built in memory).
+
+Usage: python benchmarks/large_values.py [value_size_bytes] [iterations]
+"""
+import sys
+import time
+
+from twisted.test import proto_helpers
+
+from toycache.cache import Cache
+from toycache.cache_interface import CacheInterface
+from toycache.network_interface import CacheProtocol
+
+
+class NullTransport(proto_helpers.StringTransport):
+    """
+    Transport counting written bytes instead of keeping them.
+    """
+    def __init__(self):
+        proto_helpers.StringTransport.__init__(self)
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+
+def run(chunk_size, value_size, iterations):
+    protocol = CacheProtocol(CacheInterface(Cache(chunk_size=chunk_size)))
+    transport = NullTransport()
+    protocol.makeConnection(transport)
+
+    protocol.dataReceived("set foo 0 0 {size}\r\n".format(size=value_size))
+    protocol.dataReceived("x" * value_size + "\r\n")
+
+    started_at = time.time()
+    for _ in range(iterations):
+        protocol.dataReceived("get foo\r\n")
+    elapsed = time.time() - started_at
+
+    return elapsed, transport.bytes_written
+
+
+def main():
+    value_size = int(sys.argv[1]) if len(sys.argv) > 1 else 5 * 1024 * 1024
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    for name, chunk_size in [("chunked", 64 * 1024), ("not chunked", value_size + 1)]:
+        elapsed, bytes_written = run(chunk_size, value_size, iterations)
+        print("{name:12} {gets:10.1f} gets/s {mb:10.1f} MB/s".format(
+            name=name, gets=iterations / elapsed, mb=bytes_written / elapsed / 1024 / 1024
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Latency of small gets over loopback TCP and over Unix domain socket.
+
+Starts the server (reactor running in a background thread) listening on both, then sends gets
+of a small value one at a time over a blocking socket and reports latency percentiles.
+
+Usage: python benchmarks/socket_latency.py [requests]
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import timeit
+
+from twisted.internet import reactor
+
+from toycache.network_interface import CacheService
+
+
+def read_response(client, terminator="END\r\n"):
+    response = ""
+    while not response.endswith(terminator):
+        response += client.recv(4096)
+
+    return response
+
+
+def run(client, requests):
+    client.sendall("set foo 0 0 5\r\nhello\r\n")
+    read_response(client, "STORED\r\n")
+
+    timer = timeit.default_timer
+    latencies = []
+
+    for _ in range(requests):
+        started_at = timer()
+        client.sendall("get foo\r\n")
+        read_response(client)
+        latencies.append(timer() - started_at)
+
+    return sorted(latencies)
+
+
+def percentile(latencies, p):
+    return latencies[min(int(len(latencies) * p / 100.0), len(latencies) - 1)]
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    unix_socket = os.path.join(tempfile.mkdtemp(), "toycache.sock")
+    service = CacheService(port_number=0, unix_socket=unix_socket)
+    service.startService()
+    tcp_port = service.ports[0].getHost().port
+
+    thread = threading.Thread(target=reactor.run, kwargs={"installSignalHandlers": False})
+    thread.start()
+
+    try:
+        tcp_client = socket.create_connection(("127.0.0.1", tcp_port))
+        tcp_client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        unix_client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix_client.connect(unix_socket)
+
+        for name, client in [("tcp", tcp_client), ("unix", unix_client)]:
+            latencies = run(client, requests)
+            print("{name:5} p50 {p50:8.1f}us  p99 {p99:8.1f}us  {rps:10.0f} gets/s".format(
+                name=name,
+                p50=percentile(latencies, 50) * 1e6,
+                p99=percentile(latencies, 99) * 1e6,
+                rps=len(latencies) / sum(latencies)
+            ))
+            client.close()
+    finally:
+        reactor.callFromThread(service.stopService)
+        reactor.callFromThread(reactor.stop)
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
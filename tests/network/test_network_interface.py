@@ -1,7 +1,46 @@
+import os
+import shutil
+import socket
+import tempfile
+from StringIO import StringIO
+
+from twisted.internet import reactor, task
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 
-from toycache.network_interface import CacheProtocolFactory
+from toycache.cache import Cache
+from toycache.cache_interface import CacheInterface
+from toycache.extstore import ExtStore
+from toycache.network_interface import CacheProtocol, CacheProtocolFactory, CacheService
+from toycache.offload import WorkerPool
+from toycache.trace import TraceReader, TraceWriter
+from ..toycache.helper import ManualThreads
+
+
+def make_temp_directory(test_case):
+    """
+    Create a temporary directory removed when the test finishes. Unlike TestCase.mktemp, the path
+    is absolute, so nothing is left in the working directory when tests are not run by trial.
+    :type test_case: twisted.trial.unittest.TestCase
+    """
+    directory = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, directory)
+
+    return directory
+
+
+def run_scheduled(clock):
+    """
+    Run calls scheduled on the clock so far, but not the ones they schedule (unlike Clock.advance),
+    i.e. one turn of the reactor.
+    :type clock: twisted.internet.task.Clock
+    """
+    calls = [call for call in clock.calls if call.getTime() <= clock.seconds()]
+
+    for call in calls:
+        clock.calls.remove(call)
+        call.called = 1
+        call.func(*call.args, **call.kw)
 
 class NetworkInterfaceTestCase(unittest.TestCase):
     """
@@ -12,6 +51,7 @@ class NetworkInterfaceTestCase(unittest.TestCase):
     def setUp(self):
         factory = CacheProtocolFactory()
         self.protocol = factory.buildProtocol(('127.0.0.1', 0))
+        self.protocol.clock = task.Clock()
         self.transport = proto_helpers.StringTransport()
         self.protocol.makeConnection(self.transport)
 
@@ -32,4 +72,313 @@ class NetworkInterfaceTestCase(unittest.TestCase):
     def test_set_too_much_data(self):
         self.protocol.dataReceived("set foobar 0 100 11\r\n")
         self.protocol.dataReceived("Hello world 123\r\n")
-        self.assertEqual(self.protocol.processed_commands, [])
\ No newline at end of file
+        self.assertEqual(self.protocol.processed_commands, [])
+
+    def test_meta_pipeline(self):
+        self.protocol.dataReceived("ms foo 3 q\r\nbar\r\nmg foo v q\r\nmg baz v q\r\nmn\r\n")
+        self.assertEqual(self.transport.value(), "VA 3\r\nbar\r\nMN\r\n")
+
+    def test_protocol_without_factory(self):
+        protocol = CacheProtocol(CacheInterface(Cache()))
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+
+        protocol.dataReceived("set foo 0 0 3\r\nbar\r\nget foo\r\n")
+        self.assertEqual(transport.value(), "STORED\r\nVALUE foo 0 3\r\nbar\r\nEND\r\n")
+
+        protocol.connectionLost(None)
+
+    def test_get_large_value_streamed(self):
+        factory = CacheProtocolFactory()
+        factory.cache_interface = CacheInterface(Cache(chunk_size=4))
+        protocol = factory.buildProtocol(('127.0.0.1', 0))
+        transport = PausingTransport(protocol)
+        protocol.makeConnection(transport)
+
+        protocol.dataReceived("set foo 0 0 10\r\n0123456789\r\n")
+        transport.clear()
+
+        # transport pauses the producer after every write, the rest of the value and the next
+        # command wait until the buffer is drained
+        transport.pause_on_write = True
+        protocol.dataReceived("get foo\r\nget foo\r\n")
+        self.assertEqual(transport.value(), "VALUE foo 0 10\r\n")
+        self.assertEqual(len(protocol.processed_commands), 2)
+
+        transport.pause_on_write = False
+        protocol.resumeProducing()
+
+        expected = "VALUE foo 0 10\r\n0123456789\r\nEND\r\n"
+        self.assertEqual(transport.value(), expected * 2)
+        self.assertEqual(len(protocol.processed_commands), 3)
+        self.assertIs(transport.producer, protocol)
+
+    def test_metadump_streamed(self):
+        self.protocol.dataReceived("set foo 0 0 3\r\nbar\r\n")
+        self.transport.clear()
+
+        self.protocol.dataReceived("lru_crawler metadump all\r\n")
+        self.assertTrue(self.transport.value().startswith("key=foo exp=-1 "))
+        self.assertFalse(self.transport.value().endswith("END\r\n"))
+
+        self.protocol.clock.advance(0)
+        self.assertTrue(self.transport.value().endswith(" size=3\r\nEND\r\n"))
+
+    def test_metadump_flushed_cache_one_batch_per_step(self):
+        for i in range(2500):
+            self.protocol.dataReceived("set key{i} 0 0 1\r\nx\r\n".format(i=i))
+        self.protocol.dataReceived("flush_all\r\n")
+        self.transport.clear()
+
+        self.protocol.dataReceived("lru_crawler metadump all\r\nget foo\r\n")
+
+        # 3 batches of at most 1000 keys, each walked in its own reactor turn, then END
+        for step in range(3):
+            self.assertEqual(self.transport.value(), "")
+            run_scheduled(self.protocol.clock)
+        self.assertEqual(self.transport.value(), "END")
+
+        # then the pipelined get is executed
+        run_scheduled(self.protocol.clock)
+        self.assertEqual(self.transport.value(), "END\r\nEND\r\n")
+        self.assertEqual(self.protocol.clock.getDelayedCalls(), [])
+
+    def test_metadump_connection_lost(self):
+        self.protocol.dataReceived("set foo 0 0 3\r\nbar\r\n")
+        self.protocol.dataReceived("lru_crawler metadump all\r\n")
+
+        self.protocol.connectionLost(None)
+
+        self.assertEqual(self.protocol.clock.getDelayedCalls(), [])
+
+    def test_registered_as_streaming_producer(self):
+        self.assertIs(self.transport.producer, self.protocol)
+        self.assertTrue(self.transport.streaming)
+
+    def test_pause_reading_when_output_full(self):
+        self.protocol.pauseProducing()
+        self.assertEqual(self.transport.producerState, "paused")
+        self.assertEqual(self.protocol.factory.stats.paused_connections, 1)
+
+        self.protocol.dataReceived("get foo\r\n")
+        self.assertEqual(self.protocol.processed_commands, [])
+
+        self.protocol.resumeProducing()
+        self.assertEqual(self.transport.producerState, "producing")
+        self.assertEqual(self.protocol.factory.stats.paused_connections, 0)
+        self.assertEqual(len(self.protocol.processed_commands), 1)
+
+    def test_max_connections(self):
+        factory = CacheProtocolFactory(max_connections=1)
+
+        first = factory.buildProtocol(('127.0.0.1', 0))
+        first.makeConnection(proto_helpers.StringTransport())
+
+        second = factory.buildProtocol(('127.0.0.1', 0))
+        transport = proto_helpers.StringTransport()
+        second.makeConnection(transport)
+
+        self.assertEqual(transport.value(), "SERVER_ERROR too many open connections\r\n")
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(factory.stats.curr_connections, 1)
+        self.assertEqual(factory.stats.rejected_connections, 1)
+
+        second.connectionLost(None)
+        first.connectionLost(None)
+        self.assertEqual(factory.stats.curr_connections, 0)
+
+    def test_tcp_nodelay(self):
+        factory = CacheProtocolFactory()
+        protocol = factory.buildProtocol(('127.0.0.1', 0))
+        transport = TCPTransport()
+        protocol.makeConnection(transport)
+
+        self.assertTrue(transport.tcp_nodelay)
+
+        factory = CacheProtocolFactory(tcp_nodelay=False)
+        protocol = factory.buildProtocol(('127.0.0.1', 0))
+        transport = TCPTransport()
+        protocol.makeConnection(transport)
+
+        self.assertFalse(transport.tcp_nodelay)
+
+
+    def test_pause_reading_over_high_water(self):
+        factory = CacheProtocolFactory(output_high_water=10)
+        protocol = factory.buildProtocol(('127.0.0.1', 0))
+        transport = BufferingTransport()
+        protocol.makeConnection(transport)
+
+        protocol.dataReceived("get foo\r\n")
+        self.assertFalse(transport.producerPaused)
+
+        protocol.dataReceived("set foo 0 0 10\r\n0123456789\r\nget foo\r\n")
+        self.assertTrue(transport.producerPaused)
+        self.assertEqual(transport.producerState, "paused")
+        self.assertEqual(factory.stats.paused_connections, 1)
+
+        # the transport resumes the producer once the output has been written, the pipelined get
+        # fills the output again
+        transport.clear()
+        protocol.resumeProducing()
+        self.assertEqual(transport.value(), "VALUE foo 0 10\r\n0123456789\r\nEND\r\n")
+        self.assertEqual(transport.producerState, "paused")
+
+        transport.clear()
+        protocol.resumeProducing()
+        self.assertEqual(transport.producerState, "producing")
+        self.assertEqual(factory.stats.paused_connections, 0)
+
+    def test_offloaded_command_pauses_reading(self):
+        threads = ManualThreads()
+        directory = make_temp_directory(self)
+        # values spilled to the extstore are rebuilt by append, in a worker thread
+        cache = Cache(max_items=1, extstore=ExtStore(directory), extstore_min_size=3)
+        self.addCleanup(cache.extstore.close)
+        factory = CacheProtocolFactory(
+            cache, worker_pool=WorkerPool(run_in_thread=threads), offload_threshold=4
+        )
+        protocol = factory.buildProtocol(('127.0.0.1', 0))
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+
+        protocol.dataReceived("set foo 0 0 3\r\nbar\r\nset other 0 0 1\r\nx\r\n")
+        transport.clear()
+
+        protocol.dataReceived("append foo 0 0 2\r\n12\r\nget foo\r\n")
+        self.assertEqual(transport.value(), "")
+        self.assertEqual(len(protocol.processed_commands), 3)
+
+        threads.run_next()
+
+        self.assertEqual(transport.value(), "STORED\r\nVALUE foo 0 5\r\nbar12\r\nEND\r\n")
+        self.assertEqual(len(protocol.processed_commands), 4)
+
+
+    def test_trace(self):
+        trace_file = StringIO()
+        factory = CacheProtocolFactory(trace=TraceWriter(trace_file))
+        protocol = factory.buildProtocol(('127.0.0.1', 0))
+        protocol.makeConnection(proto_helpers.StringTransport())
+
+        protocol.dataReceived("set foo 0 0 3\r\nbar\r\nget foo\r\n")
+
+        records = list(TraceReader(StringIO(trace_file.getvalue())))
+        self.assertEqual([record.line for record in records], ["set foo 0 0 3", "get foo"])
+        self.assertEqual(records[0].data, "bar")
+
+
+class CacheServiceTestCase(unittest.TestCase):
+    def test_listen_tcp_and_unix(self):
+        path = os.path.join(make_temp_directory(self), "toycache.sock")
+        service = CacheService(port_number=0, unix_socket=path, receive_buffer=65536)
+        service.startService()
+
+        self.assertEqual(len(service.ports), 2)
+        self.assertEqual(service.ports[1].getHost().name, path)
+
+        return service.stopService()
+
+    def test_listen_unix_only(self):
+        path = os.path.join(make_temp_directory(self), "toycache.sock")
+        service = CacheService(port_number=None, unix_socket=path)
+        service.startService()
+
+        self.assertEqual(len(service.ports), 1)
+
+        return service.stopService()
+
+    def test_listen_unix_stale_socket(self):
+        path = os.path.join(make_temp_directory(self), "toycache.sock")
+
+        # socket file and lock of a server which didn't shut down cleanly
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(path)
+        stale.close()
+        os.symlink(str(2 ** 30), path + ".lock")
+
+        service = CacheService(port_number=None, unix_socket=path)
+        service.startService()
+
+        self.assertEqual(service.ports[0].getHost().name, path)
+
+        return service.stopService()
+
+    def test_extstore_compacted(self):
+        path = make_temp_directory(self)
+        service = CacheService(port_number=None, extstore_path=path, compact_batch=4)
+        service.startService()
+
+        extstore = service.cache.extstore
+        extstore.segment_size = 12
+        pointers = [extstore.write(value) for value in ["abcd", "efgh", "ijkl", "mnop"]]
+        extstore.free(pointers[1])
+        extstore.free(pointers[2])
+
+        # run the periodic task right away
+        service._reclaim_call.cancel()
+        service.reclaim()
+
+        self.assertEqual(extstore.compacted_bytes, 4)
+        self.assertEqual(extstore.read(pointers[0]), "abcd")
+
+        service.stopService()
+        self.assertEqual(os.listdir(path), [])
+
+
+    def test_reclaim_scheduling(self):
+        service = CacheService(port_number=None, reclaim_batch=10)
+        service.startService()
+        self.addCleanup(service.stopService)
+        service._reclaim_call.cancel()
+
+        for i in range(20):
+            service.cache.set("key:{i}".format(i=i), "value", 0)
+        service.cache.delete("key:0")
+
+        # a few invalid items are left for the next periodic run
+        service.reclaim()
+        self.assertGreater(service._reclaim_call.getTime(), reactor.seconds())
+        service._reclaim_call.cancel()
+
+        # bulk invalidation is swept run after run
+        service.cache.flush_all()
+        service.reclaim()
+        self.assertLessEqual(service._reclaim_call.getTime(), reactor.seconds())
+
+
+class TCPTransport(proto_helpers.StringTransport):
+    tcp_nodelay = False
+
+    def setTcpNoDelay(self, enabled):
+        self.tcp_nodelay = enabled
+
+
+class PausingTransport(proto_helpers.StringTransport):
+    """
+    Transport which can simulate full write buffer by pausing the producer after each write.
+    """
+    def __init__(self, protocol):
+        proto_helpers.StringTransport.__init__(self)
+        self.protocol = protocol
+        self.pause_on_write = False
+
+    def write(self, data):
+        proto_helpers.StringTransport.write(self, data)
+
+        if self.pause_on_write:
+            self.protocol.pauseProducing()
+
+
+class BufferingTransport(proto_helpers.StringTransport):
+    """
+    Transport keeping all written data pending, like Twisted's transports do until the socket is
+    ready for writing.
+    """
+    dataBuffer = ""
+    offset = 0
+    producerPaused = False
+
+    @property
+    def _tempDataLen(self):
+        return len(self.value())
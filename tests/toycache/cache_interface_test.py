@@ -1,7 +1,12 @@
+import shutil
+import tempfile
 import unittest
 
 from toycache.cache import Cache
-from toycache.cache_interface import CacheProtocolCommand, CacheInterface
+from toycache.extstore import ExtStore
+from toycache.cache_interface import CacheProtocolCommand, CacheInterface, StreamedData
+from toycache.offload import WorkerPool
+from .helper import ManualThreads, Timer
 
 
 class CacheInterfaceTestCase(unittest.TestCase):
@@ -30,6 +35,222 @@ class CacheInterfaceTestCase(unittest.TestCase):
         self.assertEqual(result.state, "END")
         self.assertEqual(result.data, "VALUE foo 0 9\r\nFoobar123")
 
+    def test_exec_get_large_value(self):
+        cache = Cache(chunk_size=4)
+        cache.set("foo", "Foobar123", 0)
+
+        cmd = CacheProtocolCommand.process_command("get foo")
+        result = CacheInterface(cache).execute(cmd)
+
+        self.assertEqual(result.state, "END")
+        self.assertEqual(result.data.length, 24)
+        self.assertEqual(list(result.data), ["VALUE foo 0 9\r\n", "Foob", "ar12", "3"])
+
+        result = CacheInterface(cache).execute(cmd)
+        self.assertEqual(str(result), "VALUE foo 0 9\r\nFoobar123\r\nEND")
+
+    def test_exec_lget_miss(self):
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("lget foo"))
+        self.assertEqual(result.state, "END")
+        self.assertEqual(result.data, "LEASE 1")
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("lget foo"))
+        self.assertEqual(result.state, "END")
+        self.assertEqual(result.data, "WAIT")
+
+    def test_exec_lget_hit(self):
+        self._cache.set("foo", "Foobar123", 0)
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("lget foo"))
+        self.assertEqual(result.state, "END")
+        self.assertEqual(result.data, "VALUE foo 0 9\r\nFoobar123")
+
+    def test_exec_lget_stale(self):
+        timer = Timer()
+        cache = Cache(timer=timer, stale_grace=10)
+        cache_interface = CacheInterface(cache)
+        cache.set("foo", "bar", 1)
+        timer.tick()
+
+        result = cache_interface.execute(CacheProtocolCommand.process_command("lget foo"))
+        self.assertEqual(result.data, "VALUE foo 0 3 STALE\r\nbar\r\nLEASE 1")
+
+        result = cache_interface.execute(CacheProtocolCommand.process_command("lget foo"))
+        self.assertEqual(result.data, "VALUE foo 0 3 STALE\r\nbar")
+
+    def test_exec_lset(self):
+        self._cache_interface.execute(CacheProtocolCommand.process_command("lget foo"))
+
+        cmd = CacheProtocolCommand.process_command("lset foo 0 100 3 2")
+        cmd.data = "bar"
+        self.assertEqual(self._cache_interface.execute(cmd).state, "NOT_STORED")
+
+        cmd = CacheProtocolCommand.process_command("lset foo 0 100 3 1")
+        cmd.data = "bar"
+        self.assertEqual(self._cache_interface.execute(cmd).state, "STORED")
+        self.assertEqual(self._cache.get("foo"), "bar")
+
+    def test_exec_lset_no_token(self):
+        cmd = CacheProtocolCommand.process_command("lset foo 0 100 3")
+        cmd.data = "bar"
+
+        result = self._cache_interface.execute(cmd)
+        self.assertTrue(result.state.startswith("CLIENT_ERROR"))
+
+    def test_exec_get_multiple(self):
+        self._cache.set("foo", "Foobar123", 0)
+        self._cache.set("bar", "abc", 0, 1)
+
+        cmd = CacheProtocolCommand.process_command("get foo baz bar")
+        result = self._cache_interface.execute(cmd)
+
+        self.assertEqual(result.state, "END")
+        self.assertEqual(result.data, "VALUE foo 0 9\r\nFoobar123\r\nVALUE bar 1 3\r\nabc")
+
+    def test_exec_touch(self):
+        self._cache.set("foo", "bar", 10)
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("touch foo 0"))
+        self.assertEqual(result.state, "TOUCHED")
+        self.assertIsNone(self._cache.get_cached_item("foo").expires_at)
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("touch baz 0"))
+        self.assertEqual(result.state, "NOT_FOUND")
+
+    def test_exec_gat(self):
+        timer = Timer()
+        cache = Cache(timer=timer)
+        cache.set("foo", "bar", 1)
+        cache.set("baz", "qux", 1)
+
+        cmd = CacheProtocolCommand.process_command("gat 10 foo missing baz")
+        result = CacheInterface(cache).execute(cmd)
+
+        self.assertEqual(result.data, "VALUE foo 0 3\r\nbar\r\nVALUE baz 0 3\r\nqux")
+
+        timer.tick()
+        self.assertEqual(cache.get("foo"), "bar")
+        self.assertEqual(cache.get("baz"), "qux")
+
+    def test_exec_gats(self):
+        item = self._cache.set("foo", "bar", 0)
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("gats 10 foo"))
+        self.assertEqual(result.data, "VALUE foo 0 3 {cas}\r\nbar".format(cas=item.cas))
+
+    def test_exec_gat_no_keys(self):
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("gat 10"))
+        self.assertEqual(result.state, "ERROR")
+
+    def test_exec_mg_touch(self):
+        cache = Cache(timer=Timer())
+        cache.set("foo", "bar", 10)
+
+        result = CacheInterface(cache).execute(CacheProtocolCommand.process_command("mg foo T30 t"))
+        self.assertEqual(str(result), "HD t30")
+
+    def test_exec_get_flags(self):
+        self._cache.set("foo", "bar", 0, 5)
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("get foo"))
+        self.assertEqual(result.data, "VALUE foo 5 3\r\nbar")
+
+    def test_exec_mg_miss(self):
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("mg foo v"))
+        self.assertEqual(str(result), "EN")
+
+    def test_exec_mg_miss_quiet(self):
+        cmd = CacheProtocolCommand.process_command("mg foo v q Oabc")
+        self.assertIsNone(self._cache_interface.execute(cmd))
+
+    def test_exec_mg_value(self):
+        item = self._cache.set("foo", "bar", 0, 7)
+
+        cmd = CacheProtocolCommand.process_command("mg foo s v f c t k O123")
+        result = self._cache_interface.execute(cmd)
+
+        self.assertIsNone(result.state)
+        self.assertEqual(
+            str(result), "VA 3 s3 f7 c{cas} t-1 kfoo O123\r\nbar".format(cas=item.cas)
+        )
+        self.assertEqual(self._cache.stats.get_hits, 1)
+
+    def test_exec_mg_no_value(self):
+        timer = Timer()
+        cache = Cache(timer=timer)
+        cache.set("foo", "bar", 10)
+        timer.tick()
+
+        result = CacheInterface(cache).execute(CacheProtocolCommand.process_command("mg foo t"))
+        self.assertEqual(str(result), "HD t9")
+
+    def test_exec_mg_vivify(self):
+        cmd = CacheProtocolCommand.process_command("mg foo v N30 q")
+
+        self.assertEqual(str(self._cache_interface.execute(cmd)), "EN W")
+        self.assertEqual(str(self._cache_interface.execute(cmd)), "EN Z")
+
+    def test_exec_mg_vivify_stale(self):
+        timer = Timer()
+        cache = Cache(timer=timer, stale_grace=10)
+        cache_interface = CacheInterface(cache)
+        cache.set("foo", "bar", 1)
+        timer.tick()
+
+        cmd = CacheProtocolCommand.process_command("mg foo v N30")
+        self.assertEqual(str(cache_interface.execute(cmd)), "VA 3 X W\r\nbar")
+        self.assertEqual(str(cache_interface.execute(cmd)), "VA 3 X Z\r\nbar")
+
+    def test_exec_ms(self):
+        cmd = CacheProtocolCommand.process_command("ms foo 3 T10 F4 k O1")
+        cmd.data = "bar"
+
+        result = self._cache_interface.execute(cmd)
+        self.assertEqual(str(result), "HD kfoo O1")
+
+        item = self._cache.get_item("foo")
+        self.assertEqual(item.value, "bar")
+        self.assertEqual(item.flags, 4)
+
+    def test_exec_ms_quiet(self):
+        cmd = CacheProtocolCommand.process_command("ms foo 3 q")
+        cmd.data = "bar"
+
+        self.assertIsNone(self._cache_interface.execute(cmd))
+
+    def test_exec_ms_modes(self):
+        cmd = CacheProtocolCommand.process_command("ms foo 3 MA")
+        cmd.data = "bar"
+        self.assertEqual(str(self._cache_interface.execute(cmd)), "NS")
+
+        cmd = CacheProtocolCommand.process_command("ms foo 3 ME")
+        cmd.data = "bar"
+        self.assertEqual(str(self._cache_interface.execute(cmd)), "HD")
+
+        cmd = CacheProtocolCommand.process_command("ms foo 1 MP q")
+        cmd.data = "_"
+        self.assertIsNone(self._cache_interface.execute(cmd))
+
+        self.assertEqual(self._cache.get("foo"), "_bar")
+
+    def test_exec_ms_invalid_mode(self):
+        cmd = CacheProtocolCommand.process_command("ms foo 3 MX")
+        cmd.data = "bar"
+
+        result = self._cache_interface.execute(cmd)
+        self.assertTrue(result.state.startswith("CLIENT_ERROR"))
+
+    def test_exec_md(self):
+        self._cache.set("foo", "bar", 0)
+
+        cmd = CacheProtocolCommand.process_command("md foo O9")
+        self.assertEqual(str(self._cache_interface.execute(cmd)), "HD O9")
+        self.assertEqual(str(self._cache_interface.execute(cmd)), "NF O9")
+
+    def test_exec_mn(self):
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("mn"))
+        self.assertEqual(str(result), "MN")
+
     def test_exec_incr_not_exists(self):
         result = self._cache_interface.execute(CacheProtocolCommand.process_command("incr foo 2"))
         self.assertEqual(result.state, "NOT_FOUND")
@@ -42,6 +263,22 @@ class CacheInterfaceTestCase(unittest.TestCase):
         self.assertEqual(result.state, 22)
         self.assertIsNone(result.data)
 
+    def test_exec_get_counter(self):
+        self._cache.set("foo", "12", 0)
+        self._cache_interface.execute(CacheProtocolCommand.process_command("incr foo 10"))
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("get foo"))
+        self.assertEqual(result.data, "VALUE foo 0 2\r\n22")
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("mg foo v"))
+        self.assertEqual(str(result), "VA 2\r\n22")
+
+    def test_exec_incr_invalid_delta(self):
+        self._cache.set("foo", "12", 0)
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("incr foo x"))
+        self.assertEqual(result.state, "CLIENT_ERROR invalid numeric delta argument")
+
     def test_exec_decr_not_exists(self):
         result = self._cache_interface.execute(CacheProtocolCommand.process_command("decr foo 2"))
         self.assertEqual(result.state, "NOT_FOUND")
@@ -117,6 +354,19 @@ class CacheInterfaceTestCase(unittest.TestCase):
         self.assertEqual(result.state, "STORED")
         self.assertIsNone(result.data)
 
+    def test_exec_get_snapshot_of_appended_value(self):
+        cache = Cache(chunk_size=4)
+        cache_interface = CacheInterface(cache)
+        cache.set("foo", "0123456789", 0)
+
+        result = cache_interface.execute(CacheProtocolCommand.process_command("get foo"))
+        cache.append("foo", "ab", 0)
+
+        self.assertEqual(str(result.data), "VALUE foo 0 10\r\n0123456789")
+
+        result = cache_interface.execute(CacheProtocolCommand.process_command("get foo"))
+        self.assertEqual(str(result.data), "VALUE foo 0 12\r\n0123456789ab")
+
     def test_exec_append_not_exists(self):
         cmd = CacheProtocolCommand.process_command("append foo 0 100 4")
         cmd.data = "barz"
@@ -126,6 +376,72 @@ class CacheInterfaceTestCase(unittest.TestCase):
         self.assertEqual(result.state, "NOT_STORED")
         self.assertIsNone(result.data)
 
+    def _spilled_cache(self):
+        """
+        Cache with "foo" spilled to the extstore, append and prepend rebuild such values
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        cache = Cache(max_items=1, extstore=ExtStore(directory), extstore_min_size=3)
+        self.addCleanup(cache.extstore.close)
+        cache.set("foo", "bar", 0)
+        cache.set("other", "x", 0)
+
+        return cache
+
+    def test_exec_append_offloaded(self):
+        threads = ManualThreads()
+        cache = self._spilled_cache()
+        cache_interface = CacheInterface(
+            cache, worker_pool=WorkerPool(run_in_thread=threads), offload_threshold=5
+        )
+
+        prepend = CacheProtocolCommand.process_command("prepend foo 0 0 2")
+        prepend.data = "ab"
+        results = []
+        cache_interface.execute(prepend).addCallback(results.append)
+
+        # get of the same key waits for the prepend
+        get = CacheProtocolCommand.process_command("get foo")
+        cache_interface.execute(get).addCallback(results.append)
+
+        stats = cache_interface.execute(CacheProtocolCommand.process_command("stats"))
+        self.assertIn("STAT offload_queue_depth 1\r\nSTAT offload_waiting 1", stats.data)
+
+        self.assertEqual(results, [])
+        self.assertEqual(cache.get("foo"), "bar")
+
+        threads.run_next()
+
+        self.assertEqual([result.state for result in results], ["STORED", "END"])
+        self.assertEqual(results[1].data, "VALUE foo 0 5\r\nabbar")
+
+        # the value is back in memory and extended in place
+        append = CacheProtocolCommand.process_command("append foo 0 0 2")
+        append.data = "12"
+        self.assertEqual(cache_interface.execute(append).state, "STORED")
+        self.assertEqual(cache.get("foo"), "abbar12")
+
+    def test_exec_append_offloaded_item_deleted(self):
+        threads = ManualThreads()
+        cache = self._spilled_cache()
+        cache_interface = CacheInterface(
+            cache, worker_pool=WorkerPool(run_in_thread=threads), offload_threshold=1
+        )
+
+        cmd = CacheProtocolCommand.process_command("append foo 0 0 2")
+        cmd.data = "12"
+        results = []
+        cache_interface.execute(cmd).addCallback(results.append)
+
+        # delete from the cache directly, e.g. flush or eviction
+        cache.delete("foo")
+        threads.run_next()
+
+        self.assertEqual(results[0].state, "NOT_STORED")
+        self.assertIsNone(cache.get("foo"))
+
     def test_exec_prepend_exists(self):
         self._cache.set("foo", "bar", 0)
 
@@ -154,6 +470,66 @@ class CacheInterfaceTestCase(unittest.TestCase):
         self.assertEqual(result.state, "OK")
         self.assertIsNone(result.data)
 
+    def test_exec_flush_all_delayed(self):
+        timer = Timer()
+        cache = Cache(timer=timer)
+        cache.set("foo", "bar", 0)
+
+        cmd = CacheProtocolCommand.process_command("flush_all 10")
+        result = CacheInterface(cache).execute(cmd)
+
+        self.assertEqual(result.state, "OK")
+        self.assertEqual(cache.get("foo"), "bar")
+
+        for _ in range(10):
+            timer.tick()
+
+        self.assertIsNone(cache.get("foo"))
+
+    def test_exec_lru_crawler_metadump(self):
+        timer = Timer()
+        cache = Cache(timer=timer)
+        foo = cache.set("foo", "bar", 10)
+        baz = cache.set("baz", "quux", 0)
+
+        cmd = CacheProtocolCommand.process_command("lru_crawler metadump all")
+        result = CacheInterface(cache).execute(cmd)
+
+        self.assertIsNone(result.state)
+        lines = str(result).split("\r\n")
+        self.assertEqual(lines[-1], "END")
+        self.assertEqual(sorted(lines[:-1]), [
+            "key=baz exp=-1 la=0 cas={cas} size=4".format(cas=baz.cas),
+            "key=foo exp=10 la=0 cas={cas} size=3".format(cas=foo.cas),
+        ])
+
+    def test_exec_lru_crawler_metadump_empty(self):
+        cmd = CacheProtocolCommand.process_command("lru_crawler metadump all")
+        result = self._cache_interface.execute(cmd)
+
+        self.assertEqual(str(result), "END")
+
+    def test_exec_lru_crawler_metadump_flushed(self):
+        for i in range(2500):
+            self._cache.set("key{i}".format(i=i), "x", 0)
+        self._cache.flush_all()
+
+        cmd = CacheProtocolCommand.process_command("lru_crawler metadump all")
+        result = self._cache_interface.execute(cmd)
+
+        # one (empty) piece per crawl batch, so that no piece walks the whole cache
+        self.assertTrue(result.data.incremental)
+        self.assertEqual(list(result.data), ["", "", "", "END"])
+
+    def test_exec_ns_bump(self):
+        self._cache.set("tenant1:foo", "bar", 0)
+
+        cmd = CacheProtocolCommand.process_command("ns_bump tenant1")
+        result = self._cache_interface.execute(cmd)
+
+        self.assertEqual(result.state, "OK")
+        self.assertIsNone(self._cache.get("tenant1:foo"))
+
     def test_exec_stats(self):
         self._cache.stats.get_hits = 1
         self._cache.stats.get_misses = 3
@@ -172,8 +548,112 @@ class CacheInterfaceTestCase(unittest.TestCase):
         cmd = CacheProtocolCommand.process_command("stats")
         result = self._cache_interface.execute(cmd)
 
-        self.assertEqual(result.state, "")
-        self.assertEqual(result.data, expected)
+        self.assertEqual(result.state, "END")
+        self.assertTrue(result.data.startswith(expected))
+        self.assertIn("STAT rejected_connections 0", result.data)
+
+    def test_exec_get_spilled_value(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        cache = Cache(max_items=1, chunk_size=4, extstore=ExtStore(directory), extstore_min_size=5)
+        cache_interface = CacheInterface(cache)
+        cache.set("foo", "0123456789", 0)
+        cache.set("bar", "bar", 0)
+
+        reads = []
+        read = cache.extstore.read
+        cache.extstore.read = lambda *args: reads.append(args) or read(*args)
+
+        result = cache_interface.execute(CacheProtocolCommand.process_command("get foo"))
+
+        # the value is read from the extstore chunk by chunk while it's written
+        self.assertIsInstance(result.data, StreamedData)
+        pieces = iter(result.data)
+        self.assertEqual(next(pieces), "VALUE foo 0 10\r\n")
+        self.assertEqual(len(reads), 0)
+        self.assertEqual(next(pieces), "0123")
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(list(pieces), ["4567", "89"])
+
+        result = cache_interface.execute(CacheProtocolCommand.process_command("stats"))
+        self.assertIn("STAT extstore_hits 1\r\nSTAT extstore_items 1\r\n"
+                      "STAT extstore_live_bytes 10", result.data)
+
+        cache.extstore.close()
+
+    def test_slowlog(self):
+        timer = Timer()
+        cache_interface = CacheInterface(self._cache, timer=timer, slowlog_threshold=1)
+
+        cmd = CacheProtocolCommand.process_command("set foo 0 0 3")
+        cmd.data = "bar"
+        cache_interface.execute(cmd)
+        self.assertEqual(len(cache_interface.slowlog), 0)
+
+        # every command taking at least one tick is slow
+        original_set = self._cache.set
+        def slow_set(*args):
+            timer.tick()
+            return original_set(*args)
+        self._cache.set = slow_set
+
+        cache_interface.execute(cmd)
+        self.assertEqual(len(cache_interface.slowlog), 1)
+
+        entry = cache_interface.slowlog[0]
+        self.assertEqual((entry.command, entry.key, entry.size, entry.duration), ("set", "foo", 3, 1))
+
+        result = cache_interface.execute(CacheProtocolCommand.process_command("stats slowlog"))
+        self.assertEqual(result.state, "END")
+        self.assertEqual(result.data, "SLOWLOG 1 0.000000 1000000 set foo 3")
+
+    def test_slowlog_bounded(self):
+        cache_interface = CacheInterface(self._cache, slowlog_threshold=0, slowlog_max_len=2)
+
+        for key in ["a", "b", "c"]:
+            cache_interface.execute(CacheProtocolCommand.process_command("get " + key))
+
+        self.assertEqual([entry.key for entry in cache_interface.slowlog], ["b", "c"])
+
+    def test_slowlog_streamed_data(self):
+        self._cache.set("foo", "bar", 0)
+        cache_interface = CacheInterface(self._cache, slowlog_threshold=0)
+
+        cmd = CacheProtocolCommand.process_command("lru_crawler metadump all")
+        result = cache_interface.execute(cmd)
+
+        entry = cache_interface.slowlog[0]
+        self.assertEqual((entry.command, entry.key, entry.size), ("lru_crawler", "-", 0))
+        self.assertTrue(str(result.data).endswith("END"))
+
+    def test_profile(self):
+        self._cache.set("foo", "bar", 0)
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("profile dump"))
+        self.assertEqual(str(result), "END")
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("profile start 60"))
+        self.assertEqual(result.state, "OK")
+
+        self._cache_interface.execute(CacheProtocolCommand.process_command("get foo"))
+        self._cache_interface.execute(CacheProtocolCommand.process_command("profile stop"))
+
+        result = self._cache_interface.execute(CacheProtocolCommand.process_command("profile dump 100"))
+        self.assertEqual(result.state, "END")
+        self.assertIn("(get_items) 1 ", result.data)
+        self.assertTrue(all(line.startswith("PROFILE ") for line in result.data.split("\r\n")))
+
+    def test_profile_expires(self):
+        timer = Timer()
+        cache_interface = CacheInterface(self._cache, timer=timer)
+
+        cache_interface.execute(CacheProtocolCommand.process_command("profile start 1"))
+        timer.tick()
+        cache_interface.execute(CacheProtocolCommand.process_command("get foo"))
+
+        result = cache_interface.execute(CacheProtocolCommand.process_command("profile dump"))
+        self.assertEqual(str(result), "END")
 
 class CacheProtocolCommandTestCase(unittest.TestCase):
     def test_process_command_invalid(self):
@@ -208,6 +688,18 @@ class CacheProtocolCommandTestCase(unittest.TestCase):
 
         self.assertRaises(AttributeError, lambda: CacheProtocolCommand.process_command("set a"))
 
+    def test_process_command_meta_set(self):
+        command = CacheProtocolCommand.process_command("ms foo 5 T60")
+
+        self.assertEqual(command.expected_bytes, 5)
+        self.assertRaises(AttributeError, lambda: CacheProtocolCommand.process_command("ms foo"))
+
+    def test_keys(self):
+        self.assertEqual(CacheProtocolCommand.process_command("get a b").keys(), ["a", "b"])
+        self.assertEqual(CacheProtocolCommand.process_command("gat 10 a b").keys(), ["a", "b"])
+        self.assertEqual(CacheProtocolCommand.process_command("set a 0 0 1").keys(), ["a"])
+        self.assertEqual(CacheProtocolCommand.process_command("flush_all").keys(), [])
+
     def test_process_command_expecting_bytes_not_int(self):
         self.assertRaises(ValueError, lambda: CacheProtocolCommand.process_command("set a 0 60 a"))
 
@@ -1,6 +1,9 @@
+import shutil
+import tempfile
 import unittest
 
-from toycache.cache import Cache, ClientError
+from toycache.cache import Cache, ClientError, ChunkedValue, CounterValue, ExtValue, KeyCrawler
+from toycache.extstore import ExtStore
 from .helper import Timer
 
 
@@ -79,6 +82,91 @@ class CacheTestCase(unittest.TestCase):
 
         self.assertEqual(self._cache.decr("foo", 4), 6)
 
+    def test_incr_wraps_around(self):
+        self._cache.set("foo", str(2 ** 64 - 2), 0)
+
+        self.assertEqual(self._cache.incr("foo", 3), 1)
+
+    def test_decr_stops_at_zero(self):
+        self._cache.set("foo", "3", 0)
+
+        self.assertEqual(self._cache.decr("foo", 10), 0)
+
+    def test_incr_invalid(self):
+        self._cache.set("foo", "-3", 0)
+        self.assertRaises(ClientError, lambda: self._cache.incr("foo", 1))
+
+        self._cache.set("foo", "3", 0)
+        self.assertRaises(ClientError, lambda: self._cache.incr("foo", "abc"))
+        self.assertRaises(ClientError, lambda: self._cache.decr("foo", -1))
+        self.assertRaises(ClientError, lambda: self._cache.incr("foo", 2 ** 64))
+
+    def test_counter_read_as_string(self):
+        self._cache.set("foo", "9", 0, 5)
+        self._cache.incr("foo", 1)
+        self._cache.incr("foo", 1)
+
+        item = self._cache.get_item("foo")
+        self.assertIsInstance(item.value, CounterValue)
+        self.assertEqual(len(item.value), 2)
+        self.assertEqual(item.flags, 5)
+        self.assertEqual(self._cache.get("foo"), "11")
+
+        self._cache.append("foo", "x", 0)
+        self.assertEqual(self._cache.get("foo"), "11x")
+
+    def test_incr_new_version(self):
+        item = self._cache.set("foo", "1", 0)
+        cas = item.cas
+        self._timer.tick()
+
+        self._cache.incr("foo", 1)
+        self.assertNotEqual(item.cas, cas)
+        self.assertEqual(item.accessed_at, 1)
+
+        cas = item.cas
+        self._cache.decr("foo", 1)
+        self.assertNotEqual(item.cas, cas)
+
+    def test_get_many(self):
+        self._cache.set("foo", "1", 0)
+        self._cache.set("bar", "2", 1)
+        self._timer.tick()
+
+        self.assertEqual(self._cache.get_many(["foo", "bar", "baz", "foo"]), {"foo": "1"})
+        self.assertEqual(self._cache.stats.get_hits, 2)
+        self.assertEqual(self._cache.stats.get_misses, 2)
+
+        self._cache.flush_all()
+        self.assertEqual(self._cache.get_many(["foo"]), {})
+
+    def test_get_and_touch_many(self):
+        self._cache.set("foo", "1", 1)
+
+        items = self._cache.get_and_touch_many(["foo", "bar"], 5)
+
+        self.assertEqual(list(items.keys()), ["foo"])
+        self.assertEqual(items["foo"].expires_at, 5)
+        self.assertEqual(self._cache.stats.touch_hits, 1)
+        self.assertEqual(self._cache.stats.touch_misses, 1)
+
+    def test_set_many(self):
+        items = self._cache.set_many({"foo": "1", "bar": "2"}, 5, 3)
+
+        self.assertEqual(items["foo"].flags, 3)
+        self.assertEqual(items["bar"].expires_at, 5)
+        self.assertEqual(self._cache.get_many(["foo", "bar"]), {"foo": "1", "bar": "2"})
+        self.assertEqual(self._cache.stats.sets, 2)
+
+    def test_delete_many(self):
+        self._cache.set("foo", "1", 0)
+        self._cache.set("bar", "2", 1)
+        self._timer.tick()
+
+        self.assertEqual(self._cache.delete_many(["foo", "bar", "baz"]),
+                         {"foo": True, "bar": False, "baz": False})
+        self.assertIsNone(self._cache.get("foo"))
+
     def test_delete_not_exists(self):
         self.assertFalse(self._cache.delete("foobar"))
 
@@ -131,8 +219,469 @@ class CacheTestCase(unittest.TestCase):
 
         self.assertTrue(self._cache.flush_all())
 
+        self.assertIsNone(self._cache.get("foo"))
+
+        # memory is reclaimed lazily
+        self.assertEqual(self._cache.reclaim(), 1)
         self.assertEqual(len(self._cache.keys()), 0)
+
+    def test_flush_all_then_set(self):
+        self._cache.set("foo", "bar", 0)
+        self._cache.flush_all()
+        self._cache.set("foo", "baz", 0)
+
+        self.assertEqual(self._cache.get("foo"), "baz")
+
+    def test_flush_all_delayed(self):
+        self._cache.set("foo", "bar", 0)
+        self.assertTrue(self._cache.flush_all(2))
+
+        self._timer.tick()
+        self._cache.set("baz", "qux", 0)
+        self.assertEqual(self._cache.get("foo"), "bar")
+
+        self._timer.tick()
         self.assertIsNone(self._cache.get("foo"))
+        self.assertIsNone(self._cache.get("baz"))
+
+        self._cache.set("foo", "new", 0)
+        self.assertEqual(self._cache.get("foo"), "new")
+
+    def test_get_with_lease_hit(self):
+        self._cache.set("foo", "bar", 0)
+
+        self.assertEqual(self._cache.get_with_lease("foo"), ("bar", None, False))
+        self.assertEqual(self._cache.stats.get_hits, 1)
+
+    def test_get_with_lease_only_first_miss_granted(self):
+        value, token, stale = self._cache.get_with_lease("foo")
+
+        self.assertIsNone(value)
+        self.assertIsNotNone(token)
+        self.assertFalse(stale)
+
+        self.assertEqual(self._cache.get_with_lease("foo"), (None, None, False))
+        self.assertEqual(self._cache.stats.leases_granted, 1)
+
+    def test_get_with_lease_expired_lease(self):
+        _, token, _ = self._cache.get_with_lease("foo")
+
+        for _ in range(self._cache.lease_ttl):
+            self._timer.tick()
+
+        _, new_token, _ = self._cache.get_with_lease("foo")
+
+        self.assertIsNotNone(new_token)
+        self.assertNotEqual(token, new_token)
+
+    def test_get_with_lease_expired_leases_dropped(self):
+        for i in range(100):
+            self._cache.get_with_lease("key:{i}".format(i=i))
+
+        self.assertEqual(len(self._cache._leases), 100)
+
+        for _ in range(self._cache.lease_ttl):
+            self._timer.tick()
+
+        self._cache.get_with_lease("foo")
+
+        self.assertEqual(list(self._cache._leases.keys()), ["foo"])
+
+    def test_get_with_lease_stale(self):
+        cache = Cache(timer=self._timer, stale_grace=5)
+        cache.set("foo", "bar", 1)
+        self._timer.tick()
+
+        self.assertIsNone(cache.get("foo"))
+
+        value, token, stale = cache.get_with_lease("foo")
+        self.assertEqual(value, "bar")
+        self.assertIsNotNone(token)
+        self.assertTrue(stale)
+
+        self.assertEqual(cache.get_with_lease("foo"), ("bar", None, True))
+
+        for _ in range(5):
+            self._timer.tick()
+
+        self.assertIsNone(cache.get_with_lease("foo")[0])
+
+    def test_set_with_lease(self):
+        _, token, _ = self._cache.get_with_lease("foo")
+
+        self.assertFalse(self._cache.set_with_lease("foo", "bar", 0, token + 1))
+        self.assertTrue(self._cache.set_with_lease("foo", "bar", 0, token))
+        self.assertEqual(self._cache.get("foo"), "bar")
+
+        # lease is used up
+        self.assertFalse(self._cache.set_with_lease("foo", "barz", 0, token))
+
+    def test_set_with_lease_after_delete(self):
+        _, token, _ = self._cache.get_with_lease("foo")
+        self._cache.delete("foo")
+
+        self.assertFalse(self._cache.set_with_lease("foo", "bar", 0, token))
+
+    def test_set_large_value_chunked(self):
+        cache = Cache(timer=self._timer, chunk_size=4)
+        item = cache.set("foo", "0123456789", 0)
+
+        self.assertIsInstance(item.value, ChunkedValue)
+        self.assertEqual(item.value.chunks, ["0123", "4567", "89"])
+        self.assertEqual(len(item.value), 10)
+
+        self.assertEqual(cache.get("foo"), "0123456789")
+        self.assertIsInstance(cache.get_item("foo").value, ChunkedValue)
+
+    def test_append_large_value(self):
+        cache = Cache(timer=self._timer, chunk_size=4)
+        cache.set("foo", "0123456789", 0)
+
+        self.assertTrue(cache.append("foo", "ab", 0))
+        self.assertEqual(cache.get("foo"), "0123456789ab")
+
+    def test_set_flags_and_cas(self):
+        first = self._cache.set("foo", "bar", 0, 42)
+        second = self._cache.set("foo", "bar", 0)
+
+        self.assertEqual(first.flags, 42)
+        self.assertEqual(second.flags, 0)
+        self.assertNotEqual(first.cas, second.cas)
+
+    def test_append_keeps_flags(self):
+        self._cache.set("foo", "bar", 0, 3)
+        self._cache.append("foo", "123", 0)
+
+        self.assertEqual(self._cache.get_item("foo").flags, 3)
+
+    def test_append_in_place(self):
+        cache = Cache(timer=self._timer, chunk_size=4)
+        first = cache.set("foo", "ab", 0)
+
+        for i in range(10):
+            cache.append("foo", str(i), 5)
+
+        item = cache.get_item("foo")
+        self.assertIs(item, first)
+        self.assertEqual(str(item.value), "ab0123456789")
+        self.assertEqual(len(item.value), 12)
+        # small pieces are joined once they add up to a chunk
+        self.assertEqual(item.value.chunks, ["ab01", "2345", "6789"])
+        self.assertEqual(item.expires_at, 5)
+        self.assertNotEqual(item.cas, 1)
+
+        cache.append("foo", "xxxxxxxxxy", 0)
+        self.assertEqual(item.value.chunks, ["ab01", "2345", "6789", "xxxx", "xxxx", "xy"])
+        self.assertEqual(len(item.value), 22)
+
+    def test_prepend_in_place(self):
+        cache = Cache(timer=self._timer, chunk_size=4)
+        cache.set("foo", "ab", 0)
+
+        for i in range(6):
+            cache.prepend("foo", str(i), 0)
+
+        item = cache.get_item("foo")
+        self.assertEqual(item.value.chunks, ["5432", "10ab"])
+        self.assertEqual(len(item.value), 8)
+
+        cache.append("foo", "cd", 0)
+        cache.prepend("foo", "yxxxxx", 0)
+        self.assertEqual(cache.get("foo"), "yxxxxx543210abcd")
+        self.assertEqual(len(item.value), 16)
+
+    def test_append_small_value(self):
+        self._cache.set("foo", "ab", 0)
+        self._cache.append("foo", "cd", 0)
+
+        self.assertEqual(self._cache.get_item("foo").value, "abcd")
+
+    def test_concatenate(self):
+        cache = Cache(timer=self._timer, chunk_size=4)
+        item = cache.set("foo", "bar", 0)
+
+        self.assertEqual(str(cache.concatenate(item, "12")), "bar12")
+        self.assertEqual(str(cache.concatenate(item, "12", prepend=True)), "12bar")
+        self.assertIsInstance(cache.concatenate(item, "12"), ChunkedValue)
+        # the cache itself is not touched
+        self.assertEqual(cache.get("foo"), "bar")
+
+    def test_replace_concatenated(self):
+        item = self._cache.set("foo", "bar", 0, 3)
+
+        self.assertTrue(self._cache.replace_concatenated("foo", item, "bar12", 0))
+        self.assertEqual(self._cache.get("foo"), "bar12")
+        self.assertEqual(self._cache.get_item("foo").flags, 3)
+
+        # item was replaced since the value was built
+        self.assertFalse(self._cache.replace_concatenated("foo", item, "bar34", 0))
+        self.assertEqual(self._cache.get("foo"), "bar12")
+
+        item = self._cache.get_cached_item("foo")
+        self._cache.delete("foo")
+        self.assertFalse(self._cache.replace_concatenated("foo", item, "bar34", 0))
+
+    def test_remaining_ttl(self):
+        self.assertEqual(self._cache.remaining_ttl(self._cache.set("foo", "bar", 0)), -1)
+
+        item = self._cache.set("foo", "bar", 5)
+        self._timer.tick()
+        self.assertEqual(self._cache.remaining_ttl(item), 4)
+
+    def test_touch(self):
+        item = self._cache.set("foo", "bar", 2)
+        self._timer.tick()
+
+        self.assertTrue(self._cache.touch("foo", 5))
+        self.assertIs(self._cache.get_cached_item("foo"), item)
+        self.assertEqual(item.expires_at, 6)
+
+        self.assertTrue(self._cache.touch("foo", 0))
+        self.assertIsNone(item.expires_at)
+
+        self.assertEqual(self._cache.stats.touch_hits, 2)
+
+    def test_touch_not_exists(self):
+        self.assertFalse(self._cache.touch("foo", 5))
+        self.assertEqual(self._cache.stats.touch_misses, 1)
+
+    def test_get_and_touch(self):
+        self._cache.set("foo", "bar", 2)
+
+        item = self._cache.get_and_touch("foo", 10)
+        self.assertEqual(item.value, "bar")
+        self.assertEqual(item.expires_at, 10)
+        self.assertEqual(self._cache.stats.get_hits, 1)
+
+        self.assertIsNone(self._cache.get_and_touch("baz", 10))
+        self.assertEqual(self._cache.stats.get_misses, 1)
+
+    def test_bump_namespace(self):
+        self._cache.set("tenant1:foo", "bar", 0)
+        self._cache.set("tenant2:foo", "bar", 0)
+        self._cache.set("foo", "bar", 0)
+
+        self.assertEqual(self._cache.bump_namespace("tenant1"), 1)
+
+        self.assertIsNone(self._cache.get("tenant1:foo"))
+        self.assertEqual(self._cache.get("tenant2:foo"), "bar")
+        self.assertEqual(self._cache.get("foo"), "bar")
+
+        self._cache.set("tenant1:foo", "baz", 0)
+        self.assertEqual(self._cache.get("tenant1:foo"), "baz")
+
+    def test_bump_namespace_no_stale_lease_value(self):
+        cache = Cache(timer=self._timer, stale_grace=10)
+        cache.set("tenant1:foo", "bar", 0)
+        cache.bump_namespace("tenant1")
+
+        value, token, stale = cache.get_with_lease("tenant1:foo")
+        self.assertIsNone(value)
+        self.assertFalse(stale)
+
+    def test_bump_namespace_invalidates_lease(self):
+        _, token, _ = self._cache.get_with_lease("tenant1:foo")
+        self._cache.bump_namespace("tenant1")
+
+        self.assertFalse(self._cache.set_with_lease("tenant1:foo", "old", 0, token))
+        self.assertIsNone(self._cache.get("tenant1:foo"))
+
+        # leases of other namespaces are not affected
+        _, token, _ = self._cache.get_with_lease("tenant2:foo")
+        self._cache.bump_namespace("tenant1")
+        self.assertTrue(self._cache.set_with_lease("tenant2:foo", "bar", 0, token))
+
+    def test_reclaim(self):
+        self._cache.set("tenant1:foo", "bar", 0)
+        self._cache.set("tenant1:bar", "bar", 0)
+        self._cache.set("expired", "bar", 1)
+        self._cache.set("deleted", "bar", 0)
+        self._cache.set("valid", "bar", 0)
+
+        self._cache.bump_namespace("tenant1")
+        self._cache.delete("deleted")
+        self._timer.tick()
+
+        reclaimed = 0
+        for _ in range(5):
+            reclaimed += self._cache.reclaim(1)
+
+        self.assertEqual(reclaimed, 4)
+        self.assertEqual(self._cache.stats.reclaimed, 4)
+        self.assertEqual(list(self._cache.keys()), ["valid"])
+
+    def test_reclaim_keeps_stale_values(self):
+        cache = Cache(timer=self._timer, stale_grace=5)
+        cache.set("foo", "bar", 1)
+        self._timer.tick()
+
+        self.assertEqual(cache.reclaim(), 0)
+
+        for _ in range(5):
+            self._timer.tick()
+
+        self.assertEqual(cache.reclaim(), 1)
+
+    def test_crawl(self):
+        self._cache.set("foo", "bar", 0)
+        self._cache.set("bar", "bar", 1)
+        self._cache.set("baz", "bar", 0)
+        self._cache.delete("baz")
+        self._timer.tick()
+
+        batches = list(self._cache.crawl(batch_size=2))
+
+        self.assertEqual(len(batches), 2)
+        self.assertEqual([item.key for batch in batches for item in batch], ["foo"])
+
+    def test_crawl_while_modified(self):
+        for key in ["a", "b", "c", "d"]:
+            self._cache.set(key, "value", 0)
+
+        keys = []
+        for batch in self._cache.crawl(batch_size=1):
+            keys.extend(item.key for item in batch)
+            # removing and adding keys must not break the walk
+            self._cache._cache.pop("c", None)
+            self._cache.set("e", "value", 0)
+
+        self.assertEqual(keys, ["a", "b", "d", "e"])
+
+    def test_crawl_visits_used_keys(self):
+        for key in ["a", "b", "c"]:
+            self._cache.set(key, "value", 0)
+
+        crawl = self._cache.crawl(batch_size=1)
+        self.assertEqual([item.key for item in next(crawl)], ["a"])
+
+        # "b" moves to the end as the most recently used key, it's not lost by the walk
+        self._cache.get("b")
+        self.assertEqual([item.key for batch in crawl for item in batch], ["c", "b"])
+
+    def test_crawler_batch_bounded(self):
+        for i in range(10):
+            self._cache.set("key:{i}".format(i=i), "value", 0)
+
+        crawler = KeyCrawler(self._cache._cache)
+        self.assertEqual(len(crawler.next_batch(4)), 4)
+        self.assertEqual(len(crawler.next_batch(4)), 4)
+        self.assertFalse(crawler.done)
+        self.assertEqual(len(crawler.next_batch(4)), 2)
+        self.assertTrue(crawler.done)
+
+    def test_lru_order(self):
+        cache = Cache(max_items=2)
+        cache.set("a", "value", 0)
+        cache.set("b", "value", 0)
+        cache.get("a")
+        cache.set("c", "value", 0)
+
+        self.assertEqual(list(cache.keys()), ["a", "c"])
+
+    def test_accessed_at(self):
+        item = self._cache.set("foo", "bar", 0)
+        self.assertEqual(item.accessed_at, 0)
+
+        self._timer.tick()
+        self._cache.get("foo")
+        self.assertEqual(item.accessed_at, 1)
 
 if __name__ == '__main__':
     unittest.main()
+
+
+class TieredCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._timer = Timer()
+        self._extstore = ExtStore(self._directory, segment_size=1024)
+        self._cache = Cache(max_items=2, timer=self._timer, chunk_size=4, extstore=self._extstore,
+                            extstore_min_size=5)
+
+    def tearDown(self):
+        self._extstore.close()
+        shutil.rmtree(self._directory)
+
+    def test_spill_evicted_value(self):
+        self._cache.set("foo", "0123456789", 0, 3)
+        self._cache.set("small", "abc", 0)
+        self._cache.set("bar", "bar", 0)
+        self._cache.set("baz", "baz", 0)
+
+        self.assertEqual(self._cache.spilled_items(), 1)
+        self.assertEqual(self._extstore.live_bytes, 10)
+        # small values are evicted as usual
+        self.assertIsNone(self._cache.get("small"))
+
+        item = self._cache.get_item("foo")
+        self.assertIsInstance(item.value, ExtValue)
+        self.assertEqual(list(item.value), ["0123", "4567", "89"])
+        self.assertEqual(item.flags, 3)
+        self.assertEqual(self._cache.get("foo"), "0123456789")
+        self.assertEqual(self._cache.stats.extstore_hits, 2)
+
+    def test_spilled_value_not_extended_in_place(self):
+        self._cache.set("foo", "0123456789", 0)
+        self._cache.set("bar", "bar", 0)
+        self._cache.set("baz", "baz", 0)
+
+        item = self._cache.get_item("foo")
+        self.assertFalse(self._cache.extends_in_place(item))
+        self.assertRaises(TypeError, item.value.append, "ab", 4)
+        self.assertRaises(TypeError, item.value.prepend, "ab", 4)
+        self.assertEqual(self._cache.get("foo"), "0123456789")
+
+    def test_spilled_value_replaced(self):
+        self._cache.set("foo", "0123456789", 0)
+        self._cache.set("bar", "bar", 0)
+        self._cache.set("baz", "baz", 0)
+
+        self.assertTrue(self._cache.append("foo", "ab", 0))
+
+        self.assertEqual(self._cache.get("foo"), "0123456789ab")
+        self.assertEqual(self._cache.spilled_items(), 0)
+        self.assertEqual(self._extstore.live_bytes, 0)
+
+    def test_spilled_value_deleted(self):
+        self._cache.set("foo", "0123456789", 0)
+        self._cache.set("bar", "bar", 0)
+        self._cache.set("baz", "baz", 0)
+
+        self.assertTrue(self._cache.delete("foo"))
+
+        self.assertIsNone(self._cache.get("foo"))
+        self.assertEqual(self._extstore.live_bytes, 0)
+
+    def test_spilled_counter(self):
+        self._cache.set("foo", "12345", 0)
+        self._cache.set("bar", "bar", 0)
+        self._cache.set("baz", "baz", 0)
+
+        self.assertEqual(self._cache.incr("foo", 1), 12346)
+
+        # the counter is back in memory, the stored value is freed
+        self.assertEqual(self._cache.spilled_items(), 0)
+        self.assertEqual(self._extstore.live_bytes, 0)
+
+        self.assertTrue(self._cache.append("foo", "0", 0))
+        self.assertEqual(self._cache.get("foo"), "123460")
+        self.assertTrue(self._cache.delete("foo"))
+
+    def test_expired_value_not_spilled(self):
+        self._cache.set("foo", "0123456789", 1)
+        self._timer.tick()
+        self._cache.set("bar", "bar", 0)
+        self._cache.set("baz", "baz", 0)
+
+        self.assertEqual(self._cache.spilled_items(), 0)
+
+    def test_reclaim_spilled(self):
+        self._cache.set("foo", "0123456789", 2)
+        self._cache.set("bar", "bar", 0)
+        self._cache.set("baz", "baz", 0)
+        self._timer.tick()
+        self._timer.tick()
+
+        self.assertEqual(self._cache.reclaim(), 1)
+        self.assertEqual(self._cache.spilled_items(), 0)
+        self.assertEqual(self._extstore.live_bytes, 0)
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from toycache.extstore import ExtStore
+
+
+class ExtStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._store = ExtStore(self._directory, segment_size=10, max_bytes=40)
+
+    def tearDown(self):
+        self._store.close()
+        shutil.rmtree(self._directory)
+
+    def test_write_read(self):
+        pointer = self._store.write("0123456789")
+
+        self.assertEqual(self._store.read(pointer), "0123456789")
+        self.assertEqual(self._store.read(pointer, 2, 5), "234")
+        self.assertEqual(self._store.live_bytes, 10)
+        self.assertEqual(self._store.disk_bytes, 10)
+
+    def test_segments(self):
+        first = self._store.write("abcdef")
+        second = self._store.write("ghijkl")
+        large = self._store.write("x" * 15)
+
+        self.assertEqual(self._store.read(first), "abcdef")
+        self.assertEqual(self._store.read(second), "ghijkl")
+        self.assertEqual(self._store.read(large), "x" * 15)
+        self.assertEqual(self._store.disk_bytes, 35)
+        self.assertEqual(len(os.listdir(self._directory)), 3)
+
+    def test_full(self):
+        self._store.write("x" * 30)
+
+        self.assertIsNone(self._store.write("y" * 15))
+        self.assertIsNotNone(self._store.write("y" * 10))
+
+    def test_free_removes_empty_segment(self):
+        first = self._store.write("abcdef")
+        self._store.write("ghijkl")
+
+        self._store.free(first)
+        # freeing twice is ignored
+        self._store.free(first)
+
+        self.assertEqual(self._store.live_bytes, 6)
+        self.assertEqual(self._store.disk_bytes, 10)
+        self.assertEqual(os.listdir(self._directory), ["segment-2"])
+
+    def test_compact(self):
+        first = self._store.write("ab")
+        second = self._store.write("cd")
+        third = self._store.write("efghij")
+        self._store.write("klmnopqrst")
+
+        self._store.free(third)
+
+        # the first segment is mostly empty, its values move to the end of the log one by one
+        self.assertEqual(self._store.compact(limit=1), 2)
+        self.assertIn("segment-1", os.listdir(self._directory))
+
+        self.assertEqual(self._store.compact(limit=1), 2)
+        self.assertNotIn("segment-1", os.listdir(self._directory))
+
+        self.assertEqual(self._store.compact(), 0)
+
+        self.assertEqual(self._store.read(first), "ab")
+        self.assertEqual(self._store.read(second), "cd")
+        self.assertEqual(self._store.compacted_bytes, 4)
+        self.assertEqual(self._store.live_bytes, 14)
@@ -1,6 +1,7 @@
 """
 Reusable helper methods and classes for testing
 """
+from twisted.internet.defer import Deferred
 
 
 class Timer(object):
@@ -11,4 +12,21 @@ class Timer(object):
         return self.time
 
     def tick(self):
-        self.time += 1
\ No newline at end of file
+        self.time += 1
+
+class ManualThreads(object):
+    """
+    Replacement of deferToThread for WorkerPool, functions run only when asked to.
+    """
+    def __init__(self):
+        self.pending = []
+
+    def __call__(self, function, *args):
+        deferred = Deferred()
+        self.pending.append((deferred, function, args))
+
+        return deferred
+
+    def run_next(self):
+        deferred, function, args = self.pending.pop(0)
+        deferred.callback(function(*args))
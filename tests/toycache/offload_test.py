@@ -0,0 +1,83 @@
+import unittest
+
+from twisted.internet.defer import Deferred
+
+from toycache.offload import WorkerPool
+from .helper import ManualThreads
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self._threads = ManualThreads()
+        self._pool = WorkerPool(run_in_thread=self._threads)
+
+    def test_run_idle_key(self):
+        results = []
+
+        self._pool.run(["foo"], lambda: "done").addCallback(results.append)
+
+        self.assertEqual(results, ["done"])
+        self.assertFalse(self._pool.busy(["foo"]))
+
+    def test_run_in_order(self):
+        calls = []
+        results = []
+
+        self._pool.run(["foo"], lambda: self._pool.defer_to_thread(calls.append, 1))
+        self._pool.run(["foo"], lambda: calls.append(2)).addCallback(results.append)
+
+        self.assertTrue(self._pool.busy(["foo"]))
+        self.assertEqual(self._pool.queue_depth, 1)
+        self.assertEqual(self._pool.waiting, 1)
+        self.assertEqual(calls, [])
+
+        self._threads.run_next()
+
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(results, [None])
+        self.assertFalse(self._pool.busy(["foo"]))
+        self.assertEqual(self._pool.queue_depth, 0)
+        self.assertEqual(self._pool.waiting, 0)
+        self.assertEqual(self._pool.completed, 1)
+
+    def test_other_keys_not_blocked(self):
+        calls = []
+
+        self._pool.run(["foo"], lambda: self._pool.defer_to_thread(calls.append, 1))
+        self._pool.run(["bar"], lambda: calls.append(2))
+
+        self.assertEqual(calls, [2])
+        self.assertFalse(self._pool.busy(["bar"]))
+
+    def test_multiple_keys_wait_for_all(self):
+        calls = []
+
+        self._pool.run(["foo"], lambda: self._pool.defer_to_thread(calls.append, 1))
+        self._pool.run(["bar"], lambda: self._pool.defer_to_thread(calls.append, 2))
+        self._pool.run(["foo", "bar"], lambda: calls.append(3))
+
+        self._threads.run_next()
+        self.assertEqual(calls, [1])
+
+        self._threads.run_next()
+        self.assertEqual(calls, [1, 2, 3])
+
+    def test_failure_does_not_block_key(self):
+        failures = []
+        results = []
+
+        def fail():
+            raise ValueError("broken")
+
+        deferred = Deferred()
+        self._pool.run(["foo"], lambda: deferred).addErrback(failures.append)
+        self._pool.run(["foo"], lambda: "next").addCallback(results.append)
+
+        deferred.errback(ValueError("broken"))
+
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(results, ["next"])
+
+        self._pool.run(["foo"], fail).addErrback(failures.append)
+        self.assertEqual(len(failures), 2)
+        self.assertFalse(self._pool.busy(["foo"]))
@@ -0,0 +1,98 @@
+import unittest
+from StringIO import StringIO
+
+from toycache.cache import Cache
+from toycache.cache_interface import CacheProtocolCommand
+from toycache.replay import replay, CacheTarget
+from toycache.trace import TraceReader, TraceWriter
+from .helper import Timer
+
+
+class TraceTestCase(unittest.TestCase):
+    def setUp(self):
+        self._timer = Timer()
+        self._file = StringIO()
+
+    def _commands(self, writer, lines):
+        for line in lines:
+            data = None
+            if "|" in line:
+                line, data = line.split("|")
+
+            command = CacheProtocolCommand.process_command(line)
+            command.data = data
+            writer.record(command)
+            self._timer.tick()
+
+    def _records(self):
+        return list(TraceReader(StringIO(self._file.getvalue())))
+
+    def test_write_read(self):
+        writer = TraceWriter(self._file, value_bytes=3, timer=self._timer)
+        self._commands(writer, ["set foo 0 0 6|abcdef", "get foo bar", "mn"])
+
+        records = self._records()
+
+        self.assertEqual([record.timestamp for record in records], [0, 1, 2])
+        self.assertEqual([record.line for record in records], ["set foo 0 0 6", "get foo bar", "mn"])
+        self.assertEqual(records[0].data_size, 6)
+        self.assertEqual(records[0].data, "abc")
+        self.assertEqual(records[0].command().data, "abcxxx")
+        self.assertEqual(records[1].data_size, -1)
+        self.assertIsNone(records[1].command().data)
+
+    def test_hash_values(self):
+        writer = TraceWriter(self._file, values="hash", timer=self._timer)
+        self._commands(writer, ["set foo 0 0 6|abcdef"])
+
+        record = self._records()[0]
+
+        self.assertEqual(len(record.data), 8)
+        self.assertNotIn("abc", record.data)
+        self.assertEqual(len(record.command().data), 6)
+
+    def test_sampling(self):
+        writer = TraceWriter(self._file, sample_rate=0.5, timer=self._timer)
+        keys = ["key:{i}".format(i=i) for i in range(1000)]
+        self._commands(writer, ["get " + key for key in keys] + ["get " + key for key in keys])
+        self._commands(writer, ["flush_all"])
+
+        lines = [record.line for record in self._records()]
+
+        self.assertTrue(400 < writer.recorded < 1200)
+        self.assertEqual(writer.recorded + writer.skipped, 2001)
+        self.assertEqual(lines[-1], "flush_all")
+        # all commands of a sampled key are recorded
+        self.assertEqual(len(lines) - 1, 2 * len(set(lines[:-1])))
+
+    def test_not_a_trace(self):
+        self.assertRaises(ValueError, lambda: TraceReader(StringIO("foo")))
+
+    def test_replay_cache(self):
+        writer = TraceWriter(self._file, timer=self._timer)
+        self._commands(writer, ["set foo 0 0 3|bar", "get foo", "get bar", "incr foo 1"])
+
+        target = CacheTarget(Cache())
+        latencies = replay(self._records(), target)
+
+        self.assertEqual(len(latencies), 4)
+        self.assertEqual(target.stats(), {"get_hits": 1, "get_misses": 1})
+        self.assertEqual(target.cache.get("foo"), "bar")
+        self.assertEqual(target.errors, 1)
+
+    def test_replay_speed(self):
+        writer = TraceWriter(self._file, timer=self._timer)
+        self._commands(writer, ["get foo", "get foo", "get foo"])
+
+        sleeps = []
+        replay_timer = Timer()
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            replay_timer.time += seconds
+
+        latencies = replay(self._records(), CacheTarget(Cache()), speed=2,
+                           timer=replay_timer, sleep=sleep)
+
+        self.assertEqual(sleeps, [0.5, 0.5])
+        self.assertEqual(latencies, [0, 0, 0])
@@ -1,7 +1,9 @@
+import collections
+import itertools
 import time
 import sys
 
-from cachetools import LRUCache
+import cachetools
 
 
 class CacheStats(object):
@@ -9,13 +11,26 @@ class CacheStats(object):
     Holding data related to cache access statistics.
 
     While some other data structure such MutableMapping might be more universal, it might be a too
-    complex given that we have < 10 fields. And standard dict would be slightly too cumbersome to
-    use.
+    complex given that we have a handful of fields. And standard dict would be slightly too
+    cumbersome to use.
     """
     def __init__(self):
         self.get_hits = 0
         self.get_misses = 0
         self.sets = 0
+        self.stale_hits = 0
+        self.leases_granted = 0
+        self.touch_hits = 0
+        self.touch_misses = 0
+        self.reclaimed = 0
+        # gets served from the second tier, see ExtStore
+        self.extstore_hits = 0
+
+        # updated by the network interface
+        self.curr_connections = 0
+        self.total_connections = 0
+        self.rejected_connections = 0
+        self.paused_connections = 0
 
 class Cache(object):
     """
@@ -24,7 +39,9 @@ class Cache(object):
     Uses cachetools implementation via composition to reduce the complexity of the project
     and avoid reimplementing and testing common things.
     """
-    def __init__(self, max_items=10000, timer=time.time):
+    def __init__(self, max_items=10000, timer=time.time, stale_grace=0, lease_ttl=10,
+                 chunk_size=64 * 1024, namespace_separator=":", extstore=None,
+                 extstore_min_size=4096):
         """
         Initialize the cache
         :param max_items: Maximum number of *items* that can be cached. Does not limit the size
@@ -32,50 +49,281 @@ class Cache(object):
         :param timer:     Callable that returns current time (int/float). Defaults to time.time
                           which returns local Unix time, however can be overriden with custom
                           function which is very useful when testing as it gives more control.
+        :param stale_grace: For how long (in timer units) an expired item can still be served as
+                            stale by `get_with_lease`. 0 disables serving stale values.
+        :param lease_ttl: For how long (in timer units) a lease is held before another client can
+                          be granted a new one for the same key.
+        :param chunk_size: Values longer than this many bytes are stored as a list of chunks of
+                           this size (see ChunkedValue) so that they can be streamed.
+        :param namespace_separator: Namespace of a key is the part before this separator, e.g.
+                                    "tenant1" for "tenant1:user:42". Keys without it don't
+                                    belong to any namespace.
+        :type extstore: toycache.extstore.ExtStore
+        :param extstore: Second storage tier. Values of items evicted from memory are written
+                         there instead of being dropped, only the item with a pointer to its
+                         value stays in memory.
+        :param extstore_min_size: Values smaller than this many bytes are not worth spilling to
+                                  the extstore, such items are evicted as usual
         """
-        # we use LRUCache instead of TTLCache because TTLCache implementation of expiration is not
+        # we use LRU cache instead of TTLCache because TTLCache implementation of expiration is not
         # flexible enough and doesn't match our needs (TTLCache uses cache-wide standard TTL period
         # and we want to use different TTL periods for different items).
-        self._cache = LRUCache(max_items)
         self._timer = timer
         self.stats = CacheStats()
 
-    def set(self, key, value, ttl):
+        self.extstore = extstore
+        self.extstore_min_size = extstore_min_size
+
+        if extstore is None:
+            self._cache = PeekableLRUCache(max_items)
+        else:
+            self._cache = TieredLRUCache(max_items, extstore, self._spill, chunk_size)
+
+        self.stale_grace = stale_grace
+        self.lease_ttl = lease_ttl
+        # key -> (token, lease expires_at, generation of key's namespace), in the order the leases
+        # were granted, which is also the order they expire in
+        self._leases = collections.OrderedDict()
+        self._lease_tokens = itertools.count(1)
+
+        self.chunk_size = chunk_size
+        self._cas_uniques = itertools.count(1)
+
+        self.namespace_separator = namespace_separator
+        # namespace -> generation, items of older generations are invalid. Namespaces which have
+        # never been bumped are at generation 0 and are not stored.
+        self._generations = {}
+
+        # flush_all does not remove items, it bumps the epoch and items stored in older epochs are
+        # invalid. Delayed flush is applied once the time comes.
+        self._epoch = 0
+        self._flush_at = None
+
+        # crawler walked by `reclaim` in slices
+        self._reclaim_crawler = None
+
+    def set(self, key, value, ttl, flags=0):
         """
         Set value for cache item
         :param key: Item key
         :param value: Item value
         :param ttl: Time to live in units of the timer set (default: seconds).
+        :param flags: Opaque client flags stored along with the value
         :return: Created cached item
         :rtype: CachedItem
         """
 
-        cached_item = self.set_cached_item(key, value, ttl)
+        cached_item = self.set_cached_item(key, value, ttl, flags)
         self.stats.sets += 1
 
         return cached_item
 
-    def set_cached_item(self, key, value, ttl):
+    def set_cached_item(self, key, value, ttl, flags=0):
         """
         Set value for cache item, intended for internal usage because it does not update stats
         (and possibly other things).
         :param key: Item key
         :param value: Item value
         :param ttl: Time to live in units of the timer set (default: seconds).
+        :param flags: Opaque client flags stored along with the value
         :return: Created cached item
         :rtype: CachedItem
         """
+        now = self._timer()
+
+        return self._store(key, value, self._expires_at(ttl, now), flags, now)
+
+    def set_many(self, values, ttl, flags=0):
+        """
+        Set values of multiple keys at once. Cheaper than calling `set` for each key, the clock is
+        read once for the whole batch.
+        :param values: Dict key -> value
+        :param ttl: Time to live in units of the timer set (default: seconds).
+        :param flags: Opaque client flags stored along with the values
+        :return: Dict key -> created CachedItem
+        """
+        now = self._timer()
+        expires_at = self._expires_at(ttl, now)
+
+        items = {}
+        for key, value in values.items():
+            items[key] = self._store(key, value, expires_at, flags, now)
+
+        self.stats.sets += len(items)
+
+        return items
 
+    def _store(self, key, value, expires_at, flags, now):
+        if self._flush_at is not None:
+            self._apply_pending_flush()
+
+        if isinstance(value, str) and len(value) > self.chunk_size:
+            value = ChunkedValue.split(value, self.chunk_size)
+
+        cached_item = CachedItem(key, value, expires_at, flags, next(self._cas_uniques))
+        cached_item.epoch = self._epoch
+        cached_item.accessed_at = now
+        cached_item.generation = self._generation(key)
+        self._cache[key] = cached_item
+
+        # the value is fresh now, whoever holds the lease has nothing to recompute
+        self._leases.pop(key, None)
+
+        return cached_item
+
+    def _expires_at(self, ttl, now=None):
+        """
+        Convert TTL to absolute expiration time
+        :param ttl: Time to live, 0 means never expires
+        :param now: Current time if already known
+        :return: Expiration time, None if never expires
+        """
         # @todo handle "Can be up to 30 days. After 30 days, is treated as a unix timestamp of an exact date."
         if ttl == 0:
-            expires_at = None
+            return None
+
+        if now is None:
+            now = self._timer()
+
+        return now + ttl
+
+    def touch(self, key, ttl):
+        """
+        Update TTL of the item stored under the given key without re-setting its value.
+        :param key: Cache key
+        :param ttl: New TTL
+        :return: True if touched, False if not found
+        """
+        item = self.get_cached_item(key)
+
+        if item is None:
+            self.stats.touch_misses += 1
+            return False
+
+        item.expires_at = self._expires_at(ttl)
+        self.stats.touch_hits += 1
+
+        return True
+
+    def get_and_touch(self, key, ttl):
+        """
+        Get the item and update its TTL in one step
+        :param key: Cache key
+        :param ttl: New TTL
+        :return: instance of CachedItem, None if not found or expired.
+        :rtype: CachedItem
+        """
+        item = self.get_item(key)
+
+        if item is None:
+            self.stats.touch_misses += 1
+            return None
+
+        item.expires_at = self._expires_at(ttl)
+        self.stats.touch_hits += 1
+
+        return item
+
+    def get_with_lease(self, key):
+        """
+        Get value of cached item, memcache lease style. On a miss, the first caller is granted a
+        lease token and is expected to recompute the value and store it with `set_with_lease`.
+        Other callers are not granted the lease until it expires, they should either wait and
+        retry or use the stale value (if the item expired less than `stale_grace` ago).
+        :param key: Key
+        :return: Tuple (value, lease_token, stale). value is None if neither valid nor stale value
+                 is available, lease_token is None if the lease was not granted.
+        """
+        item, token, stale = self.get_item_with_lease(key)
+
+        if item is None:
+            return None, token, stale
+
+        return ChunkedValue.flatten(item.value), token, stale
+
+    def get_item_with_lease(self, key):
+        """
+        Same as `get_with_lease`, but returns instance of CachedItem instead of the value.
+        :param key: Key
+        :return: Tuple (item, lease_token, stale)
+        """
+        now = self._timer()
+
+        try:
+            item = self._cache[key]
+        except KeyError:
+            item = None
+
+        if (item is not None) and (not self._is_current(item)):
+            item = None
+
+        if (item is not None) and ((item.expires_at is None) or (item.expires_at > now)):
+            self.stats.get_hits += 1
+            item.accessed_at = now
+            return item, None, False
+
+        self.stats.get_misses += 1
+
+        stale = False
+        if (item is not None) and (item.expires_at + self.stale_grace > now):
+            stale = True
+            self.stats.stale_hits += 1
         else:
-            expires_at = self._timer() + ttl
+            item = None
 
-        cached_item = CachedItem(key, value, expires_at)
-        self._cache[key] = cached_item
+        lease = self._leases.get(key)
+        if (lease is not None) and (lease[1] > now):
+            return item, None, stale
 
-        return cached_item
+        self._expire_leases(now)
+
+        token = next(self._lease_tokens)
+        self._leases[key] = (token, now + self.lease_ttl, self._generation(key))
+        self.stats.leases_granted += 1
+
+        return item, token, stale
+
+    def _expire_leases(self, now):
+        """
+        Drop expired leases, so that misses on keys which are never set don't accumulate leases.
+        Only the oldest leases need to be checked, see `_leases`.
+        :param now: Current time
+        """
+        leases = self._leases
+
+        while len(leases) > 0:
+            key = next(iter(leases))
+
+            if leases[key][1] > now:
+                break
+
+            del leases[key]
+
+    def set_with_lease(self, key, value, ttl, token, flags=0):
+        """
+        Set value for cache item if the given lease token is still valid, i.e. it has been granted
+        by `get_with_lease` and neither the key has been deleted, nor the value has been set, nor
+        the namespace of the key has been bumped since.
+        :param key: Item key
+        :param value: Item value
+        :param ttl: Time to live
+        :param token: Lease token returned by `get_with_lease`
+        :param flags: Client flags
+        :return: True if stored, False if the lease is not valid anymore
+        """
+        lease = self._leases.get(key)
+
+        if (lease is None) or (lease[0] != token):
+            return False
+
+        if lease[2] != self._generation(key):
+            # the value was computed before the namespace was invalidated
+            del self._leases[key]
+            return False
+
+        self.set(key, value, ttl, flags)
+
+        return True
 
     def get(self, key):
         """
@@ -87,14 +335,111 @@ class Cache(object):
 
         # @todo 'not found' should probably return special value because at the moment it is not
         # possible to tell whether the stored value is None or it was not found
-        if not self.holds_valid_value(key):
+        item = self.get_item(key)
+
+        if item is None:
+            return None
+
+        return ChunkedValue.flatten(item.value)
+
+    def get_item(self, key):
+        """
+        Same as `get`, but returns instance of CachedItem, e.g. to access flags or the value
+        as ChunkedValue. Updates usage stats.
+        :param key: Key
+        :return: instance of CachedItem, None if not found or expired.
+        :rtype: CachedItem
+        """
+        now = self._timer()
+
+        try:
+            item = self._cache[key]
+        except KeyError:
+            item = None
+
+        if not self._is_valid(item, now):
             self.stats.get_misses += 1
             return None
 
-        item = self._cache[key]
         self.stats.get_hits += 1
+        item.accessed_at = now
+
+        if isinstance(item.value, ExtValue):
+            self.stats.extstore_hits += 1
+
+        return item
+
+    def get_many(self, keys):
+        """
+        Get values of multiple keys at once. Cheaper than calling `get` for each key, the clock is
+        read once for the whole batch and each key is looked up once.
+        :param keys: List of keys
+        :return: Dict key -> value of the keys found, missing and expired keys are left out
+        """
+        items = self.get_items(keys)
+
+        return dict((key, ChunkedValue.flatten(item.value)) for key, item in items.items())
+
+    def get_items(self, keys):
+        """
+        Same as `get_many`, but returns instances of CachedItem. Updates usage stats.
+        :param keys: List of keys
+        :return: Dict key -> CachedItem of the keys found
+        """
+        return self._get_items(keys, self._timer())
+
+    def get_and_touch_many(self, keys, ttl):
+        """
+        Get items of multiple keys and update their TTL in one step
+        :param keys: List of keys
+        :param ttl: New TTL
+        :return: Dict key -> CachedItem of the keys found
+        """
+        now = self._timer()
+        items = self._get_items(keys, now)
+        expires_at = self._expires_at(ttl, now)
+
+        for item in items.values():
+            item.expires_at = expires_at
+
+        touched = sum(1 for key in keys if key in items)
+        self.stats.touch_hits += touched
+        self.stats.touch_misses += len(keys) - touched
+
+        return items
+
+    def _get_items(self, keys, now):
+        # pending flush is applied and the epoch read once for all the keys
+        if self._flush_at is not None:
+            self._apply_pending_flush()
+
+        store = self._cache
+        epoch = self._epoch
+        items = {}
+        hits = 0
+        extstore_hits = 0
+
+        for key in keys:
+            try:
+                item = store[key]
+            except KeyError:
+                continue
+
+            if not self._is_valid_at(item, now, epoch):
+                continue
 
-        return item.value
+            item.accessed_at = now
+            items[key] = item
+            hits += 1
+
+            if isinstance(item.value, ExtValue):
+                extstore_hits += 1
+
+        self.stats.get_hits += hits
+        self.stats.get_misses += len(keys) - hits
+        self.stats.extstore_hits += extstore_hits
+
+        return items
 
     def get_cached_item(self, key):
         """
@@ -110,6 +455,17 @@ class Cache(object):
 
         return self._cache[key]
 
+    def remaining_ttl(self, item):
+        """
+        Time left until the item expires
+        :type item: CachedItem
+        :return: Remaining time in timer units, -1 if the item never expires
+        """
+        if item.expires_at is None:
+            return -1
+
+        return int(max(item.expires_at - self._timer(), 0))
+
     def holds_valid_value(self, key):
         """
         Check if value under the given key is valid, i.e. exists and has not expired.
@@ -121,52 +477,240 @@ class Cache(object):
         except KeyError:
             return False
 
-        if (item is None) or ((item.expires_at is not None) and (item.expires_at <= self._timer())):
+        return self._is_valid(item)
+
+    def _is_valid(self, item, now=None):
+        """
+        Check if item is valid, i.e. exists, has not expired and has not been invalidated
+        :type item: CachedItem
+        :param now: Current time if already known
+        """
+        if self._flush_at is not None:
+            self._apply_pending_flush()
+
+        if now is None:
+            now = self._timer()
+
+        return self._is_valid_at(item, now, self._epoch)
+
+    def _is_valid_at(self, item, now, epoch):
+        """
+        Check if item is valid at the given time and epoch, read by the caller once for a batch of
+        items. Pending flush must have been applied before reading the epoch.
+        :type item: CachedItem
+        :param now: Current time
+        :param epoch: Current epoch of the cache
+        """
+        if (item is None) or (item.epoch != epoch):
             return False
 
-        return True
+        if (item.expires_at is not None) and (item.expires_at <= now):
+            return False
+
+        return item.generation == self._generation(item.key)
+
+    def _is_current(self, item):
+        """
+        Check that item has not been invalidated in bulk, i.e. neither the cache has been flushed
+        nor its namespace has been bumped since it was stored.
+        :type item: CachedItem
+        """
+        if self._flush_at is not None:
+            self._apply_pending_flush()
+
+        if item.epoch != self._epoch:
+            return False
+
+        return item.generation == self._generation(item.key)
+
+    def _spill(self, item):
+        """
+        Check if value of the item evicted from memory should be written to the extstore
+        :type item: CachedItem
+        """
+        if (item is None) or (len(item.value) < self.extstore_min_size):
+            return False
+
+        return self._is_valid(item)
+
+    def _namespace(self, key):
+        """
+        Namespace the given key belongs to
+        :param key: Cache key
+        :return: Namespace, None if the key does not belong to any
+        """
+        if (self.namespace_separator is None) or (self.namespace_separator not in key):
+            return None
+
+        return key.split(self.namespace_separator, 1)[0]
+
+    def _generation(self, key):
+        """
+        Current generation of the namespace the key belongs to
+        :param key: Cache key
+        """
+        if not self._generations:
+            return 0
+
+        return self._generations.get(self._namespace(key), 0)
+
+    def bump_namespace(self, namespace):
+        """
+        Invalidate all items in the given namespace in O(1) by incrementing its generation.
+        The memory used by invalidated items is reclaimed lazily by `reclaim`.
+        :param namespace: Namespace
+        :return: New generation of the namespace
+        """
+        generation = self._generations.get(namespace, 0) + 1
+        self._generations[namespace] = generation
+
+        return generation
+
+    def reclaim(self, limit=1000):
+        """
+        Remove invalid (expired or invalidated in bulk) items from the cache. Walks the cache in
+        slices of at most `limit` keys per call so that it can be called periodically without
+        stalling other work; a new pass over the cache starts when the previous one is done.
+        :param limit: Maximum number of keys to check
+        :return: Number of removed items
+        """
+        if (self._reclaim_crawler is None) or self._reclaim_crawler.done:
+            self._reclaim_crawler = KeyCrawler(self._cache)
+
+        now = self._timer()
+        reclaimed = 0
+
+        for key, item in self._reclaim_crawler.next_batch(limit):
+            if (item is None) or (not self._is_current(item)) or (
+                    (item.expires_at is not None) and (item.expires_at + self.stale_grace <= now)):
+                del self._cache[key]
+                reclaimed += 1
+
+        self.stats.reclaimed += reclaimed
+
+        return reclaimed
+
+    def crawl(self, batch_size=1000):
+        """
+        Walk valid items of the cache in batches. It is a generator, so that a batch is only
+        processed when it's requested, e.g. once the previous one has been sent to the client.
+        Items changed after the walk started may or may not be included.
+        :param batch_size: Maximum number of keys checked per batch
+        :return: Generator of lists of CachedItem instances
+        """
+        crawler = KeyCrawler(self._cache)
+
+        while not crawler.done:
+            batch = crawler.next_batch(batch_size)
+            now = self._timer()
+
+            yield [item for key, item in batch if self._is_valid(item, now)]
 
     def incr(self, key, increment):
         """
-        Increment integer value stored under given key by a given number
+        Increment integer value stored under given key by a given number. Wraps around at 2^64.
         :param key: Cache key
         :param increment: Increase stored value by this number
         :return: New value
         """
-        item = self.get_cached_item(key)
+        increment = self._parse_delta(increment)
+        item = self._counter(key)
 
         if item is None:
             return None
 
-        try:
-            item_int = int(item.value)
-        except ValueError:
-            raise ClientError("cannot increment or decrement non-numeric value")
-
-        self._cache[key].value = item_int + int(increment)
+        item.value.increment(increment)
+        self._new_version(item)
 
-        return self._cache[key].value
+        return item.value.number
 
     def decr(self, key, decremet):
         """
-        Decrease integer value stored under given key by a given number
+        Decrease integer value stored under given key by a given number. Stops at 0.
         :param key: Cache key
         :param decremet: Decrease stored vaue by this number
         :return: New value
         """
-        item = self.get_cached_item(key)
+        decremet = self._parse_delta(decremet)
+        item = self._counter(key)
 
         if item is None:
             return None
 
+        item.value.decrement(decremet)
+        self._new_version(item)
+
+        return item.value.number
+
+    def _parse_delta(self, delta):
         try:
-            item_int = int(item.value)
+            delta = int(delta)
         except ValueError:
+            raise ClientError("invalid numeric delta argument")
+
+        if not (0 <= delta < CounterValue.limit):
+            raise ClientError("invalid numeric delta argument")
+
+        return delta
+
+    def _counter(self, key):
+        """
+        Find counter stored under the key for incr/decr. Value of the item is converted to
+        CounterValue on the first update, so that following ones don't parse it again.
+        :param key: Cache key
+        :return: CachedItem holding CounterValue, None if not found
+        :rtype: CachedItem
+        """
+        now = self._timer()
+
+        try:
+            item = self._cache[key]
+        except KeyError:
+            return None
+
+        if not self._is_valid(item, now):
+            return None
+
+        item.accessed_at = now
+
+        if isinstance(item.value, CounterValue):
+            return item
+
+        try:
+            number = int(ChunkedValue.flatten(item.value))
+        except ValueError:
+            number = -1
+
+        if not (0 <= number < CounterValue.limit):
             raise ClientError("cannot increment or decrement non-numeric value")
 
-        self._cache[key].value = item_int - int(decremet)
+        self._replace_value(item, CounterValue(number))
+
+        return item
+
+    def _replace_value(self, item, value):
+        """
+        Replace value of the item in place. Item spilled to the extstore is moved back to memory
+        and its stored value is freed.
+        :type item: CachedItem
+        :param value: New value
+        """
+        if not isinstance(item.value, ExtValue):
+            item.value = value
+            return
+
+        del self._cache[item.key]
+        item.value = value
+        self._cache[item.key] = item
 
-        return self._cache[key].value
+    def _new_version(self, item):
+        """
+        Mark item whose value has been changed in place as a new version: it gets a new CAS
+        unique and the outstanding lease of its key is invalidated, like when a value is set.
+        :type item: CachedItem
+        """
+        item.cas = next(self._cas_uniques)
+        self._leases.pop(item.key, None)
 
     def delete(self, key):
         """
@@ -174,6 +718,9 @@ class Cache(object):
         :param key: Cache key
         :return: True if deleted, False if not found
         """
+        # deleting invalidates outstanding lease so that the value computed before the delete is
+        # not stored
+        self._leases.pop(key, None)
 
         if not self.holds_valid_value(key):
             return False
@@ -182,34 +729,62 @@ class Cache(object):
 
         return True
 
-    def add(self, key, value, ttl):
+    def delete_many(self, keys):
+        """
+        Delete multiple keys at once, looking each of them up once
+        :param keys: List of keys
+        :return: Dict key -> True if deleted, False if not found
+        """
+        now = self._timer()
+        store = self._cache
+        deleted = {}
+
+        for key in keys:
+            self._leases.pop(key, None)
+
+            try:
+                item = store[key]
+            except KeyError:
+                deleted[key] = False
+                continue
+
+            deleted[key] = self._is_valid(item, now)
+
+            if deleted[key]:
+                store[key] = None
+
+        return deleted
+
+    def add(self, key, value, ttl, flags=0):
         """
         Add value to the cache if the key is not used
         :param key: Cache key
         :param value: Value to cache
         :param ttl: Time to live
+        :param flags: Client flags
         :return: True if value has been added
         """
 
         if self.holds_valid_value(key):
             return False
 
-        self.set_cached_item(key, value, ttl)
+        self.set_cached_item(key, value, ttl, flags)
 
         return True
 
-    def replace(self, key, value, ttl):
+    def replace(self, key, value, ttl, flags=0):
         """
         Replace value stored under the key
         :param key: Cache key
         :param value: Value to store
         :param ttl: New TTL
+        :param flags: Client flags
         :return: True if replaced, False if not found
         """
         if not self.holds_valid_value(key):
             return False
 
-        self.set_cached_item(key, value, ttl)
+        self.set_cached_item(key, value, ttl, flags)
 
         return True
 
@@ -228,7 +803,7 @@ class Cache(object):
         if current_data is None:
             return False
 
-        self.set_cached_item(key, current_data.value + value, ttl)
+        self._extend(key, current_data, value, ttl, prepend=False)
 
         return True
 
@@ -247,18 +822,134 @@ class Cache(object):
 
         # @todo ignore ttl?
 
-        self.set_cached_item(key, value + current_data.value, ttl)
+        self._extend(key, current_data, value, ttl, prepend=True)
 
         return True
 
-    def flush_all(self):
+    def _extend(self, key, item, value, ttl, prepend):
         """
-        Remove all items from the cache.
+        Append or prepend value to the item in place. Large values are extended as ChunkedValue,
+        so that only the new data is copied instead of the whole value.
+        """
+        if not self.extends_in_place(item):
+            self.set_cached_item(key, self.concatenate(item, value, prepend), ttl, item.flags)
+            return
+
+        current = item.value
+
+        if isinstance(current, ChunkedValue):
+            if prepend:
+                current.prepend(value, self.chunk_size)
+            else:
+                current.append(value, self.chunk_size)
+        else:
+            current = ChunkedValue.flatten(current)
+
+            if len(current) + len(value) <= self.chunk_size:
+                item.value = (value + current) if prepend else (current + value)
+            elif prepend:
+                item.value = ChunkedValue([current])
+                item.value.prepend(value, self.chunk_size)
+            else:
+                item.value = ChunkedValue([current])
+                item.value.append(value, self.chunk_size)
+
+        now = self._timer()
+        item.expires_at = self._expires_at(ttl, now)
+        item.accessed_at = now
+        self._new_version(item)
+
+    def extends_in_place(self, item):
+        """
+        Check if append and prepend extend value of the item in place. Values spilled to
+        the extstore are read back and rebuilt in memory instead, see `concatenate`.
+        :type item: CachedItem
+        """
+        return not isinstance(item.value, ExtValue)
+
+    def concatenate(self, item, value, prepend=False):
+        """
+        Build the value of the item with given value appended (or prepended). Doesn't touch
+        the cache, so it is safe to run in a worker thread as long as nobody modifies the item.
+        :param item: CachedItem to extend
+        :param value: Value to append or prepend
+        :param prepend: Prepend instead of append
+        :return: New value, already split in chunks if it is large
+        """
+        current = ChunkedValue.flatten(item.value)
+        new_value = (value + current) if prepend else (current + value)
+
+        if len(new_value) > self.chunk_size:
+            return ChunkedValue.split(new_value, self.chunk_size)
+
+        return new_value
+
+    def replace_concatenated(self, key, item, value, ttl):
+        """
+        Store value built by `concatenate` unless the item was removed, replaced, flushed or
+        has expired in the meantime.
+        :param key: Cache key
+        :param item: CachedItem the value was built from
+        :param value: New value
+        :param ttl: New TTL
+        :return: True if stored, False if the item is gone
+        """
+        if self.get_cached_item(key) is not item:
+            return False
+
+        self.set_cached_item(key, value, ttl, item.flags)
+
+        return True
+
+    def flush_all(self, delay=0):
+        """
+        Invalidate all items in the cache in O(1), now or after the given delay. Memory used by the
+        items is reclaimed lazily by `reclaim`.
+        :param delay: Invalidate items (including the ones stored in the meantime) after this
+                      many timer units
         :return: Always True
         """
-        self._cache.clear()
+        if delay > 0:
+            self._flush_at = self._timer() + delay
+            return True
+
+        self._flush_at = None
+        self._flush()
+
         return True
 
+    def _apply_pending_flush(self):
+        """
+        Flush the cache if the time of delayed flush has come.
+        """
+        if self._flush_at <= self._timer():
+            self._flush_at = None
+            self._flush()
+
+    def _flush(self):
+        self._epoch += 1
+        self._leases.clear()
+
+    def spilled_items(self):
+        """
+        Number of items with the value in the extstore
+        """
+        if self.extstore is None:
+            return 0
+
+        return len(self._cache.spilled)
+
+    def compact_extstore(self, limit=1024 * 1024):
+        """
+        Run a slice of extstore compaction, see ExtStore.compact
+        :param limit: Maximum number of bytes to move
+        :return: Number of bytes moved
+        """
+        if self.extstore is None:
+            return 0
+
+        return self.extstore.compact(limit)
+
     def keys(self):
         """
         List of keys available in Cache
@@ -266,6 +957,229 @@ class Cache(object):
         """
         return self._cache.keys()
 
+class PeekableLRUCache(cachetools.Cache):
+    """
+    LRU cache which allows looking at items without marking them as recently used, and walking
+    them while the cache is being modified (see KeyOrder), e.g. when crawling the whole cache.
+    """
+
+    def __init__(self, maxsize):
+        cachetools.Cache.__init__(self, maxsize)
+
+        self._order = KeyOrder()
+
+    def __getitem__(self, key):
+        value = cachetools.Cache.__getitem__(self, key)
+        self._order.move_to_end(key)
+
+        return value
+
+    def __setitem__(self, key, value):
+        cachetools.Cache.__setitem__(self, key, value)
+        self._order.move_to_end(key)
+
+    def __delitem__(self, key):
+        cachetools.Cache.__delitem__(self, key)
+        self._order.remove(key)
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def peek(self, key):
+        """
+        Get item without updating its position in LRU order
+        :raises KeyError: if not found
+        """
+        return cachetools.Cache.__getitem__(self, key)
+
+    def popitem(self):
+        """
+        Remove and return the least recently used (key, value) pair
+        :raises KeyError: if empty
+        """
+        key = self._order.first()
+        value = cachetools.Cache.__getitem__(self, key)
+        PeekableLRUCache.__delitem__(self, key)
+
+        return key, value
+
+
+class TieredLRUCache(PeekableLRUCache):
+    """
+    LRU cache which spills values of evicted items to ExtStore instead of dropping them. Spilled
+    items keep being accessible under their keys, with ExtValue pointing to the stored value.
+    They are removed when deleted or replaced, or once the reclaim finds them invalid.
+    """
+
+    def __init__(self, maxsize, extstore, spill, chunk_size):
+        """
+        :param maxsize: Maximum number of items kept in memory
+        :type extstore: toycache.extstore.ExtStore
+        :param spill: Callable (CachedItem) -> bool deciding if evicted item should be spilled
+        :param chunk_size: Size of chunks the spilled values are read back in
+        """
+        PeekableLRUCache.__init__(self, maxsize)
+
+        self.extstore = extstore
+        self._spill = spill
+        self._chunk_size = chunk_size
+        # key -> CachedItem with ExtValue, and the keys in the order they were spilled in, which
+        # crawlers walk
+        self.spilled = {}
+        self._spilled_order = KeyOrder()
+
+    def __getitem__(self, key):
+        try:
+            return PeekableLRUCache.__getitem__(self, key)
+        except KeyError:
+            return self.spilled[key]
+
+    def peek(self, key):
+        try:
+            return PeekableLRUCache.peek(self, key)
+        except KeyError:
+            return self.spilled[key]
+
+    def __setitem__(self, key, value):
+        if key in self.spilled:
+            self._remove_spilled(key)
+
+        PeekableLRUCache.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key in self.spilled:
+            self._remove_spilled(key)
+            return
+
+        PeekableLRUCache.__delitem__(self, key)
+
+    def __contains__(self, key):
+        return PeekableLRUCache.__contains__(self, key) or (key in self.spilled)
+
+    def __iter__(self):
+        return itertools.chain(PeekableLRUCache.__iter__(self), self._spilled_order)
+
+    def __len__(self):
+        return PeekableLRUCache.__len__(self) + len(self.spilled)
+
+    def popitem(self):
+        key, item = PeekableLRUCache.popitem(self)
+
+        if self._spill(item):
+            pointer = self.extstore.write(ChunkedValue.flatten(item.value))
+
+            if pointer is not None:
+                item.value = ExtValue(self.extstore, pointer, self._chunk_size)
+                self.spilled[key] = item
+                self._spilled_order.move_to_end(key)
+
+        return key, item
+
+    def _remove_spilled(self, key):
+        item = self.spilled.pop(key)
+        self._spilled_order.remove(key)
+        self.extstore.free(item.value.pointer)
+
+
+class KeyOrder(object):
+    """
+    Keys kept in a doubly linked list, used for LRU order. Unlike OrderedDict, it can be walked
+    while it's being modified: removed links keep pointing to the link which followed them and
+    are skipped, and a key moved to the end gets a new link, so a walk never loses its place.
+    """
+
+    def __init__(self):
+        # circular list of [previous, next, key] links, root's next is the first key
+        self._root = root = []
+        root[:] = [root, root, None]
+        # key -> its current link
+        self._links = {}
+
+    def __len__(self):
+        return len(self._links)
+
+    def __iter__(self):
+        """
+        Walk keys from the first to the last. Keys added or moved to the end during the walk are
+        visited (again) once the walk gets there.
+        """
+        root = self._root
+        link = root[1]
+
+        while link is not root:
+            key = link[2]
+
+            if self._links.get(key) is link:
+                yield key
+
+            link = link[1]
+
+    def first(self):
+        """
+        :raises KeyError: if empty
+        """
+        if len(self._links) == 0:
+            raise KeyError("KeyOrder is empty")
+
+        return self._root[1][2]
+
+    def move_to_end(self, key):
+        """
+        Add key to the end, or move it there if it's already present
+        """
+        self.remove(key)
+
+        root = self._root
+        last = root[0]
+        link = [last, root, key]
+        last[1] = root[0] = self._links[key] = link
+
+    def remove(self, key):
+        """
+        Remove key if present. The removed link is left pointing to the next one, so that walks
+        positioned at it can carry on.
+        """
+        link = self._links.pop(key, None)
+
+        if link is None:
+            return
+
+        previous, following, _ = link
+        previous[1] = following
+        following[0] = previous
+
+
+class KeyCrawler(object):
+    """
+    Walks the cache in batches, e.g. between reactor turns. Keys are walked in LRU order from
+    the least recently used one, with a cursor which stays valid while the cache is modified
+    (see KeyOrder), so every batch costs O(limit) regardless of the cache size. Keys removed
+    before the crawler gets to them are skipped, keys used or set in the meantime move to the end
+    and may be visited again.
+    """
+
+    def __init__(self, store):
+        """
+        :type store: PeekableLRUCache
+        """
+        self._store = store
+        self._keys = iter(store)
+        self.done = False
+
+    def next_batch(self, limit):
+        """
+        Get next batch of items, without marking them as recently used
+        :param limit: Maximum number of keys in the batch
+        :return: List of (key, item) tuples
+        """
+        batch = [(key, self._store.peek(key)) for key in itertools.islice(self._keys, limit)]
+
+        if len(batch) < limit:
+            self.done = True
+
+        return batch
+
+
 class ClientError(Exception):
     pass
 
@@ -278,15 +1192,195 @@ class CachedItem(object):
     Object used to hold some data around cached item.
     """
 
-    def __init__(self, key, value, expires_at):
+    def __init__(self, key, value, expires_at, flags=0, cas=0):
         """
         Initiate item
         :param key: Key
         :param value: Value
         :param expires_at: Expiration time. Expressed in timer units and is absolute (i.e. not the
                            same as TTL). Usually equals to current_time + ttl.
+        :param flags: Opaque client flags
+        :param cas: Unique value of this version of the item
         :return:
         """
         self.key = key
         self.value = value
-        self.expires_at = expires_at
\ No newline at end of file
+        self.expires_at = expires_at
+        self.flags = flags
+        self.cas = cas
+        # generation of item's namespace and cache's flush epoch at the time it was stored
+        self.generation = 0
+        self.epoch = 0
+        # time of the last get or set, None if unknown
+        self.accessed_at = None
+
+
+class ChunkedValue(object):
+    """
+    Large value stored as a list of chunks. Allows writing the value to the network chunk by
+    chunk instead of building the whole response in memory.
+    """
+
+    def __init__(self, chunks):
+        """
+        :param chunks: List of strings
+        """
+        self.chunks = chunks
+        self.length = sum(len(chunk) for chunk in chunks)
+
+        # number and total size of small chunks appended (prepended) since they were last joined
+        self._tail = (0, 0)
+        self._head = (0, 0)
+
+    def append(self, data, chunk_size):
+        """
+        Append data in place. Small pieces are joined once they add up to a chunk, so that
+        the value doesn't get fragmented and every appended byte is copied a constant number of
+        times.
+        :param data: String to append
+        :param chunk_size: Size of a chunk
+        """
+        self.length += len(data)
+
+        if len(data) >= chunk_size:
+            self.chunks.extend(ChunkedValue.split(data, chunk_size).chunks)
+            self._tail = (0, 0)
+            return
+
+        self.chunks.append(data)
+        count, size = self._tail[0] + 1, self._tail[1] + len(data)
+
+        if size >= chunk_size:
+            self.chunks[-count:] = ["".join(self.chunks[-count:])]
+            count, size = 0, 0
+
+        self._tail = (count, size)
+
+    def prepend(self, data, chunk_size):
+        """
+        Prepend data in place, see `append`
+        :param data: String to prepend
+        :param chunk_size: Size of a chunk
+        """
+        self.length += len(data)
+
+        if len(data) >= chunk_size:
+            self.chunks[:0] = ChunkedValue.split(data, chunk_size).chunks
+            self._head = (0, 0)
+            return
+
+        self.chunks.insert(0, data)
+        count, size = self._head[0] + 1, self._head[1] + len(data)
+
+        if size >= chunk_size:
+            self.chunks[:count] = ["".join(self.chunks[:count])]
+            count, size = 0, 0
+
+        self._head = (count, size)
+
+    def snapshot(self):
+        """
+        Copy of the value which doesn't change when this one is extended, e.g. to stream it to
+        the client. Only the list of chunks is copied, not the data.
+        :rtype: ChunkedValue
+        """
+        return ChunkedValue(list(self.chunks))
+
+    @staticmethod
+    def split(value, chunk_size):
+        """
+        Split string into chunks of the given size
+        :param value: String to split
+        :param chunk_size: Size of a chunk (the last one can be shorter)
+        :rtype: ChunkedValue
+        """
+        return ChunkedValue([value[i:i + chunk_size] for i in range(0, len(value), chunk_size)])
+
+    @staticmethod
+    def flatten(value):
+        """
+        Join chunked value into a single string and format counters, other values are returned
+        as they are.
+        """
+        if isinstance(value, (ChunkedValue, CounterValue)):
+            return str(value)
+
+        return value
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __str__(self):
+        return "".join(self.chunks)
+
+
+class CounterValue(object):
+    """
+    Value updated by incr/decr, kept as a number and formatted only when it is read.
+    """
+
+    # counters are 64-bit unsigned integers like in memcached
+    limit = 2 ** 64
+
+    def __init__(self, number):
+        """
+        :param number: Non-negative integer lower than `limit`
+        """
+        self.number = number
+        self._formatted = None
+
+    def increment(self, delta):
+        self.number = (self.number + delta) % CounterValue.limit
+        self._formatted = None
+
+    def decrement(self, delta):
+        self.number = max(self.number - delta, 0)
+        self._formatted = None
+
+    def __len__(self):
+        return len(str(self))
+
+    def __str__(self):
+        if self._formatted is None:
+            self._formatted = str(self.number)
+
+        return self._formatted
+
+
+class ExtValue(ChunkedValue):
+    """
+    Value spilled to ExtStore. Read back chunk by chunk when accessed, so that it's streamed like
+    any other large value.
+    """
+
+    def __init__(self, extstore, pointer, chunk_size):
+        """
+        :type extstore: toycache.extstore.ExtStore
+        :type pointer: toycache.extstore.ExtPointer
+        :param chunk_size: Size of chunks the value is read in
+        """
+        self.extstore = extstore
+        self.pointer = pointer
+        self.length = pointer.length
+        self.chunk_size = chunk_size
+
+    def append(self, data, chunk_size):
+        raise TypeError("Spilled value can't be extended in place, use Cache.concatenate")
+
+    def prepend(self, data, chunk_size):
+        raise TypeError("Spilled value can't be extended in place, use Cache.concatenate")
+
+    def snapshot(self):
+        # stored data never changes, it's read while the value is being streamed
+        return self
+
+    def __iter__(self):
+        # one chunk at a time, so that streaming the value doesn't read all of it in memory
+        for start in range(0, self.length, self.chunk_size):
+            yield self.extstore.read(self.pointer, start, min(start + self.chunk_size, self.length))
+
+    def __str__(self):
+        return self.extstore.read(self.pointer)
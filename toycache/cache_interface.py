@@ -1,60 +1,283 @@
-from toycache.cache import ClientError, ServerError
+import cProfile
+import collections
+import itertools
+import time
+
+from toycache.cache import ClientError, ServerError, ChunkedValue
 
 class CacheInterface(object):
     """
     Interface between the cache and commands received.
     """
-    def __init__(self, cache):
+    # commands which may rebuild the whole value (see Cache.extends_in_place), worth running in
+    # a worker thread for large values
+    offloaded_commands = ["append", "prepend"]
+
+    def __init__(self, cache, timer=time.time, slowlog_threshold=0.01, slowlog_max_len=128,
+                 worker_pool=None, offload_threshold=1024 * 1024):
         """
         Initiate inteface
         :type cache toycache.cache.Cache
         :param cache: Cache to bind the interface to
+        :param timer: Callable returning current time in seconds, used to measure execution time
+        :param slowlog_threshold: Commands taking longer than this many seconds are recorded in
+                                  the slow log
+        :param slowlog_max_len: Maximum number of entries in the slow log, the oldest ones are
+                                dropped
+        :type worker_pool toycache.offload.WorkerPool
+        :param worker_pool: Pool to run CPU heavy work in, everything runs in the calling thread
+                            if None
+        :param offload_threshold: Size (in bytes) of the resulting value from which append and
+                                  prepend run in the worker pool
         """
         self._cache = cache
+        self._timer = timer
+        self._worker_pool = worker_pool
+        self.offload_threshold = offload_threshold
+
+        self.slowlog_threshold = slowlog_threshold
+        self.slowlog = collections.deque(maxlen=slowlog_max_len)
+        self._slowlog_ids = itertools.count(1)
+
+        self._profiler = None
+        self._profile_until = None
 
     def execute(self, command):
         """
         Execute command on the bound cache.
+
+        With a worker pool, CPU heavy commands run in a worker thread and commands on keys with
+        such work pending wait for it to finish. Those return a Deferred firing with the result.
         :param command: CacheProtocolCommand instance
-        :return: Result of command
+        :return: Result of command or Deferred
         :rtype: CacheProtocolResult
         """
+        if self._worker_pool is None:
+            return self._execute(command)
+
+        keys = command.keys()
+
+        if self._worker_pool.busy(keys) or (self._item_to_offload(command) is not None):
+            return self._worker_pool.run(keys, lambda: self._execute_in_order(command))
+
+        return self._execute(command)
+
+    def _execute_in_order(self, command):
+        # the item may have changed while the command was waiting, decide again
+        item = self._item_to_offload(command)
+
+        if item is None:
+            return self._execute(command)
+
+        key, flags, ttl, size = command.parameters
+        ttl = int(ttl)
+
+        deferred = self._worker_pool.defer_to_thread(
+            self._cache.concatenate, item, command.data, command.command == "prepend"
+        )
+        deferred.addCallback(
+            lambda value: self._cache.replace_concatenated(key, item, value, ttl)
+        )
+        deferred.addCallback(
+            lambda stored: CacheProtocolResult("STORED" if stored else "NOT_STORED")
+        )
+
+        return deferred
+
+    def _item_to_offload(self, command):
+        """
+        Find item which the command would rebuild in a worker thread
+        :return: CachedItem or None if the command should run right away
+        """
+        if command.command not in self.offloaded_commands:
+            return None
+
+        item = self._cache.get_cached_item(command.keys()[0])
+
+        if (item is None) or self._cache.extends_in_place(item):
+            return None
+
+        if len(item.value) + len(command.data) < self.offload_threshold:
+            return None
+
+        return item
+
+    def _execute(self, command):
         method_name = "exec_{cmd}".format(cmd=command.command)
 
         if not(hasattr(self, method_name) and callable(getattr(self, method_name))):
             # @todo network interface should write back "ERROR\r\n"
             raise AttributeError("Command {cmd} is not implemented".format(cmd=command.command))
 
+        started_at = self._timer()
+
+        if (self._profile_until is not None) and (started_at >= self._profile_until):
+            self._profile_until = None
+
+        # profile commands themselves are not profiled
+        profile = (self._profile_until is not None) and (command.command != "profile")
+
         try:
+            if profile:
+                self._profiler.enable()
             result = getattr(self, method_name)(command)
         except ClientError as e:
             raise e
         except ServerError as e:
             raise e
+        finally:
+            if profile:
+                self._profiler.disable()
+
+        duration = self._timer() - started_at
+        if duration >= self.slowlog_threshold:
+            self._log_slow_command(command, result, started_at, duration)
 
         return result
 
+    def _log_slow_command(self, command, result, started_at, duration):
+        keys = command.keys()
+        key = keys[0] if len(keys) > 0 else "-"
+
+        if command.data is not None:
+            size = len(command.data)
+        elif (result is None) or (result.data is None):
+            size = 0
+        elif isinstance(result.data, StreamedData):
+            # size of lazily generated data may not be known until it's written
+            size = result.data.length if result.data.length is not None else 0
+        else:
+            size = len(result.data)
+
+        self.slowlog.append(
+            SlowLogEntry(next(self._slowlog_ids), started_at, duration, command.command, key, size)
+        )
+
     def exec_set(self, cmd):
         key, flags, ttl, size = cmd.parameters
 
         ttl = int(ttl)
 
-        self._cache.set(key, cmd.data, ttl)
+        self._cache.set(key, cmd.data, ttl, int(flags))
 
         return CacheProtocolResult("STORED")
 
     def exec_get(self, cmd):
-        key = cmd.parameters[0]
+        items = self._cache.get_items(cmd.parameters)
 
-        item = self._cache.get(key)
+        return self._values_result([(key, items.get(key)) for key in cmd.parameters])
 
-        if item is None:
+    def exec_gat(self, cmd):
+        return self._get_and_touch(cmd, with_cas=False)
+
+    def exec_gats(self, cmd):
+        return self._get_and_touch(cmd, with_cas=True)
+
+    def _get_and_touch(self, cmd, with_cas):
+        if len(cmd.parameters) < 2:
+            return CacheProtocolResult("ERROR")
+
+        try:
+            ttl = int(cmd.parameters[0])
+        except ValueError:
+            return CacheProtocolResult("CLIENT_ERROR invalid exptime argument")
+
+        keys = cmd.parameters[1:]
+        items = self._cache.get_and_touch_many(keys, ttl)
+
+        return self._values_result([(key, items.get(key)) for key in keys], with_cas)
+
+    def _values_result(self, items, with_cas=False):
+        """
+        Build result of get-like commands
+        :param items: List of (key, CachedItem) tuples, item is None if not found
+        :param with_cas: Include CAS unique of items
+        :rtype: CacheProtocolResult
+        """
+        pieces = []
+        chunked = False
+
+        for key, item in items:
+            if item is None:
+                continue
+
+            if len(pieces) > 0:
+                pieces.append("\r\n")
+
+            value = item.value
+            header = "VALUE {key} {flags} {size}".format(key=key, flags=item.flags, size=len(value))
+            if with_cas:
+                header += " {cas}".format(cas=item.cas)
+            pieces.append(header + "\r\n")
+
+            if isinstance(value, ChunkedValue):
+                chunked = True
+                pieces.append(value.snapshot())
+            else:
+                pieces.append(str(value))
+
+        if len(pieces) == 0:
             return CacheProtocolResult("END")
 
-        result_data = "VALUE {key} {flags} {size}\r\n".format(key=key, flags=0, size=len(item))
-        result_data += item # terminating \r\n will be appended automatically
+        if chunked:
+            # large values are streamed to the client chunk by chunk by the network interface
+            return CacheProtocolResult("END", StreamedData.join(pieces))
+
+        # terminating \r\n will be appended automatically
+        return CacheProtocolResult("END", "".join(pieces))
+
+    def exec_touch(self, cmd):
+        if len(cmd.parameters) < 2:
+            return CacheProtocolResult("ERROR")
+
+        try:
+            ttl = int(cmd.parameters[1])
+        except ValueError:
+            return CacheProtocolResult("CLIENT_ERROR invalid exptime argument")
+
+        if self._cache.touch(cmd.parameters[0], ttl):
+            return CacheProtocolResult("TOUCHED")
+
+        return CacheProtocolResult("NOT_FOUND")
+
+    def exec_lget(self, cmd):
+        key = cmd.parameters[0]
+
+        item, token, stale = self._cache.get_item_with_lease(key)
+
+        lines = []
+        if item is not None:
+            lines.append("VALUE {key} {flags} {size}{stale}\r\n{value}".format(
+                key=key, flags=item.flags, size=len(item.value), stale=" STALE" if stale else "",
+                value=item.value
+            ))
+
+        if token is not None:
+            lines.append("LEASE {token}".format(token=token))
+        elif item is None:
+            # somebody else holds the lease and there is nothing stale to serve, try again later
+            lines.append("WAIT")
+
+        return CacheProtocolResult("END", "\r\n".join(lines))
 
-        return CacheProtocolResult("END", result_data)
+    def exec_lset(self, cmd):
+        if len(cmd.parameters) < 5:
+            return CacheProtocolResult("CLIENT_ERROR lease token required")
+
+        key, flags, ttl, size, token = cmd.parameters[:5]
+
+        try:
+            ttl = int(ttl)
+            token = int(token)
+        except ValueError:
+            return CacheProtocolResult("CLIENT_ERROR bad command line format")
+
+        stored = self._cache.set_with_lease(key, cmd.data, ttl, token, int(flags))
+
+        if stored:
+            return CacheProtocolResult("STORED")
+
+        return CacheProtocolResult("NOT_STORED")
 
     def exec_incr(self, cmd):
         try:
@@ -89,7 +312,7 @@ class CacheInterface(object):
     def exec_add(self, cmd):
         key, flags, ttl, size = cmd.parameters
         ttl = int(ttl)
-        added = self._cache.add(key, cmd.data, ttl)
+        added = self._cache.add(key, cmd.data, ttl, int(flags))
 
         if added:
             return CacheProtocolResult("STORED")
@@ -99,7 +322,7 @@ class CacheInterface(object):
     def exec_replace(self, cmd):
         key, flags, ttl, size = cmd.parameters
         ttl = int(ttl)
-        replaced = self._cache.replace(key, cmd.data, ttl)
+        replaced = self._cache.replace(key, cmd.data, ttl, int(flags))
 
         if replaced:
             return CacheProtocolResult("STORED")
@@ -126,23 +349,367 @@ class CacheInterface(object):
 
         return CacheProtocolResult("NOT_STORED")
 
+    def exec_mg(self, cmd):
+        key = cmd.parameters[0]
+        flags = self._parse_meta_flags(cmd.parameters[1:])
+        requested = dict(flags)
+
+        return_flags = []
+        if "N" in requested:
+            # vivify on miss: the first client missing the key wins the right to recache it (W),
+            # others are told it's already being recached (Z). Stale items are marked with X.
+            item, token, stale = self._cache.get_item_with_lease(key)
+
+            if stale:
+                return_flags.append("X")
+            if token is not None:
+                return_flags.append("W")
+            elif item is None or stale:
+                return_flags.append("Z")
+        else:
+            item = self._cache.get_item(key)
+            stale = False
+
+        if "T" in requested:
+            try:
+                ttl = int(requested["T"])
+            except ValueError:
+                return CacheProtocolResult("CLIENT_ERROR bad token in command line format")
+
+            if (item is not None) and (not stale):
+                self._cache.touch(key, ttl)
+
+        if item is None:
+            if ("q" in requested) and (len(return_flags) == 0):
+                return None
+
+            return CacheProtocolResult(self._meta_line("EN", key, item, flags, return_flags))
+
+        if "v" not in requested:
+            return CacheProtocolResult(self._meta_line("HD", key, item, flags, return_flags))
+
+        value = item.value
+        code = "VA {size}".format(size=len(value))
+        header = self._meta_line(code, key, item, flags, return_flags)
+
+        if isinstance(value, ChunkedValue):
+            return CacheProtocolResult(None, StreamedData.join([header + "\r\n", value.snapshot()]))
+
+        return CacheProtocolResult(None, header + "\r\n" + str(value))
+
+    def exec_ms(self, cmd):
+        key = cmd.parameters[0]
+        flags = self._parse_meta_flags(cmd.parameters[2:])
+        requested = dict(flags)
+
+        try:
+            ttl = int(requested.get("T", 0))
+            client_flags = int(requested.get("F", 0))
+        except ValueError:
+            return CacheProtocolResult("CLIENT_ERROR bad token in command line format")
+
+        mode = requested.get("M", "S").upper()
+
+        if mode == "S":
+            self._cache.set(key, cmd.data, ttl, client_flags)
+            stored = True
+        elif mode == "E":
+            stored = self._cache.add(key, cmd.data, ttl, client_flags)
+        elif mode == "R":
+            stored = self._cache.replace(key, cmd.data, ttl, client_flags)
+        elif mode == "A":
+            stored = self._cache.append(key, cmd.data, ttl)
+        elif mode == "P":
+            stored = self._cache.prepend(key, cmd.data, ttl)
+        else:
+            return CacheProtocolResult("CLIENT_ERROR invalid mode for ms")
+
+        if not stored:
+            return CacheProtocolResult(self._meta_line("NS", key, None, flags))
+
+        if "q" in requested:
+            return None
+
+        item = self._cache.get_cached_item(key)
+
+        return CacheProtocolResult(self._meta_line("HD", key, item, flags))
+
+    def exec_md(self, cmd):
+        key = cmd.parameters[0]
+        flags = self._parse_meta_flags(cmd.parameters[1:])
+
+        if not self._cache.delete(key):
+            return CacheProtocolResult(self._meta_line("NF", key, None, flags))
+
+        if "q" in dict(flags):
+            return None
+
+        return CacheProtocolResult(self._meta_line("HD", key, None, flags))
+
+    def exec_mn(self, cmd):
+        return CacheProtocolResult("MN")
+
+    def _parse_meta_flags(self, tokens):
+        """
+        Parse flags of meta commands, each flag is a single character optionally followed by
+        an argument, e.g. "v" or "T30".
+        :param tokens: List of flag tokens
+        :return: List of (flag, argument) tuples, in the order they were given
+        """
+        return [(token[0], token[1:]) for token in tokens if len(token) > 0]
+
+    def _meta_line(self, code, key, item, flags, return_flags=None):
+        """
+        Build response line of a meta command: return code followed by the requested flags
+        :param code: Return code, e.g. HD or EN
+        :param key: Cache key
+        :param item: Instance of CachedItem, None if there is no item (e.g. on miss)
+        :param flags: Parsed flags of the command
+        :param return_flags: Additional flags to return, e.g. W for the lease winner
+        :return: Response line
+        """
+        tokens = [code]
+
+        for flag, argument in flags:
+            if flag == "k":
+                tokens.append("k" + key)
+            elif flag == "O":
+                tokens.append("O" + argument)
+            elif item is None:
+                continue
+            elif flag == "c":
+                tokens.append("c{cas}".format(cas=item.cas))
+            elif flag == "f":
+                tokens.append("f{flags}".format(flags=item.flags))
+            elif flag == "s":
+                tokens.append("s{size}".format(size=len(item.value)))
+            elif flag == "t":
+                tokens.append("t{ttl}".format(ttl=self._cache.remaining_ttl(item)))
+
+        if return_flags is not None:
+            tokens.extend(return_flags)
+
+        return " ".join(tokens)
+
+    def exec_ns_bump(self, cmd):
+        if len(cmd.parameters) < 1:
+            return CacheProtocolResult("ERROR")
+
+        self._cache.bump_namespace(cmd.parameters[0])
+
+        return CacheProtocolResult("OK")
+
+    def exec_lru_crawler(self, cmd):
+        if cmd.parameters[:1] != ["metadump"]:
+            return CacheProtocolResult("CLIENT_ERROR bad command line format")
+
+        return CacheProtocolResult(None, StreamedData(self._metadump(), incremental=True))
+
+    def _metadump(self):
+        """
+        Generate metadata of all valid items, one batch of lines at a time, followed by END. Every
+        batch of the crawl is a piece, even if it has no valid items (e.g. after flush_all), so
+        that generating a piece walks a bounded number of keys.
+        """
+        for batch in self._cache.crawl():
+            lines = []
+            for item in batch:
+                lines.append("key={key} exp={exp} la={la} cas={cas} size={size}\r\n".format(
+                    key=item.key,
+                    exp=-1 if item.expires_at is None else int(item.expires_at),
+                    la=-1 if item.accessed_at is None else int(item.accessed_at),
+                    cas=item.cas,
+                    size=len(item.value)
+                ))
+
+            yield "".join(lines)
+
+        yield "END"
+
     def exec_flush_all(self, cmd):
-        self._cache.flush_all()
+        delay = 0
+        if len(cmd.parameters) > 0:
+            try:
+                delay = int(cmd.parameters[0])
+            except ValueError:
+                return CacheProtocolResult("CLIENT_ERROR bad command line format")
+
+        self._cache.flush_all(delay)
 
         return CacheProtocolResult("OK")
 
+    def exec_profile(self, cmd):
+        if len(cmd.parameters) < 1:
+            return CacheProtocolResult("ERROR")
+
+        action = cmd.parameters[0]
+
+        if action == "start":
+            try:
+                seconds = float(cmd.parameters[1]) if len(cmd.parameters) > 1 else 10
+            except ValueError:
+                return CacheProtocolResult("CLIENT_ERROR bad command line format")
+
+            # statistics of the previous run are dropped
+            self._profiler = cProfile.Profile()
+            self._profile_until = self._timer() + seconds
+
+            return CacheProtocolResult("OK")
+
+        if action == "stop":
+            self._profile_until = None
+
+            return CacheProtocolResult("OK")
+
+        if action == "dump":
+            try:
+                limit = int(cmd.parameters[1]) if len(cmd.parameters) > 1 else 20
+            except ValueError:
+                return CacheProtocolResult("CLIENT_ERROR bad command line format")
+
+            return self._profile_dump(limit)
+
+        return CacheProtocolResult("ERROR")
+
+    def _profile_dump(self, limit):
+        """
+        Functions which took the most time (excluding time spent in functions they called) while
+        profiling.
+        """
+        if self._profiler is None:
+            return CacheProtocolResult("END")
+
+        self._profiler.create_stats()
+        stats = self._profiler.stats
+        # (file, line, function) -> (primitive calls, calls, own time, cumulative time, callers)
+        hottest = sorted(stats.items(), key=lambda function: function[1][2], reverse=True)
+
+        lines = []
+        for (filename, line, function), (_, calls, own, cumulative, _) in hottest[:limit]:
+            line_format = "PROFILE {file}:{line}({function}) {calls} {own:.6f} {cumulative:.6f}"
+            lines.append(line_format.format(
+                file=filename, line=line, function=function, calls=calls, own=own,
+                cumulative=cumulative
+            ))
+
+        if len(lines) == 0:
+            return CacheProtocolResult("END")
+
+        return CacheProtocolResult("END", "\r\n".join(lines))
+
     def exec_stats(self, cmd):
+        if (len(cmd.parameters) > 0) and (cmd.parameters[0] == "slowlog"):
+            return self._slowlog_stats()
+
         stats = self._cache.stats
-        stats_output = "STAT cmd_get {cmd_get}\r\nSTAT cmd_set {cmd_set}\r\n" \
-                       "STAT get_hits {get_hits}\r\nSTAT get_misses {get_misses}"
-        stats_output = stats_output.format(
-            cmd_get=stats.get_misses + stats.get_hits,
-            cmd_set=stats.sets,
-            get_hits=stats.get_hits,
-            get_misses=stats.get_misses
+        stats_output = [
+            ("cmd_get", stats.get_misses + stats.get_hits),
+            ("cmd_set", stats.sets),
+            ("get_hits", stats.get_hits),
+            ("get_misses", stats.get_misses),
+            ("touch_hits", stats.touch_hits),
+            ("touch_misses", stats.touch_misses),
+            ("stale_hits", stats.stale_hits),
+            ("leases_granted", stats.leases_granted),
+            ("reclaimed", stats.reclaimed),
+            ("curr_connections", stats.curr_connections),
+            ("total_connections", stats.total_connections),
+            ("rejected_connections", stats.rejected_connections),
+            ("paused_connections", stats.paused_connections),
+        ]
+
+        if self._cache.extstore is not None:
+            stats_output += [
+                ("extstore_hits", stats.extstore_hits),
+                ("extstore_items", self._cache.spilled_items()),
+                ("extstore_live_bytes", self._cache.extstore.live_bytes),
+                ("extstore_disk_bytes", self._cache.extstore.disk_bytes),
+                ("extstore_compacted_bytes", self._cache.extstore.compacted_bytes),
+            ]
+
+        if self._worker_pool is not None:
+            stats_output += [
+                ("offload_queue_depth", self._worker_pool.queue_depth),
+                ("offload_waiting", self._worker_pool.waiting),
+                ("offload_completed", self._worker_pool.completed),
+            ]
+
+        return CacheProtocolResult("END", "\r\n".join(
+            "STAT {name} {value}".format(name=name, value=value) for name, value in stats_output
+        ))
+
+
+    def _slowlog_stats(self):
+        lines = []
+        for entry in self.slowlog:
+            lines.append("SLOWLOG {id} {timestamp:.6f} {duration} {command} {key} {size}".format(
+                id=entry.id, timestamp=entry.timestamp, duration=int(entry.duration * 1000000),
+                command=entry.command, key=entry.key, size=entry.size
+            ))
+
+        if len(lines) == 0:
+            return CacheProtocolResult("END")
+
+        return CacheProtocolResult("END", "\r\n".join(lines))
+
+
+class SlowLogEntry(object):
+    """
+    Command which took longer than the slow log threshold to execute
+    """
+    def __init__(self, entry_id, timestamp, duration, command, key, size):
+        """
+        :param entry_id: Sequential number of the entry
+        :param timestamp: When the command started executing
+        :param duration: Execution time in seconds
+        :param command: Command name, e.g. get
+        :param key: First key the command operated on, "-" if none
+        :param size: Size of the data sent or received
+        """
+        self.id = entry_id
+        self.timestamp = timestamp
+        self.duration = duration
+        self.command = command
+        self.key = key
+        self.size = size
+
+
+class StreamedData(object):
+    """
+    Result data generated lazily piece by piece, e.g. while walking the whole cache. The network
+    interface writes the pieces as they are generated instead of building the whole response.
+    """
+    def __init__(self, pieces, length=None, incremental=False):
+        """
+        :param pieces: Iterable of strings
+        :param length: Total length of the pieces, None if it's not known in advance
+        :param incremental: Generating a piece is a step of a longer work (e.g. walking a batch of
+                            the cache), the network interface generates one piece per reactor
+                            turn. Pieces may be empty.
+        """
+        self.pieces = pieces
+        self.length = length
+        self.incremental = incremental
+
+    @staticmethod
+    def join(pieces):
+        """
+        Stream strings and chunked values one after another, chunked values chunk by chunk
+        :param pieces: List of strings and ChunkedValue instances
+        :rtype: StreamedData
+        """
+        return StreamedData(
+            itertools.chain.from_iterable(
+                piece if isinstance(piece, ChunkedValue) else [piece] for piece in pieces
+            ),
+            sum(len(piece) for piece in pieces)
         )
 
-        return CacheProtocolResult("", stats_output)
+    def __iter__(self):
+        return iter(self.pieces)
+
+    def __str__(self):
+        return "".join(self.pieces)
 
 
 class CacheProtocolResult(object):
@@ -152,7 +719,8 @@ class CacheProtocolResult(object):
     def __init__(self, state, data=None):
         """
         Initialize object
-        :param state: State of result, e.g. STORED, END, ERROR.
+        :param state: State of result, e.g. STORED, END, ERROR. None if the result consists of
+                      data only.
         :param data: Optional data associated with the result, e.g. value stored at key for get
                      command.
         :return:
@@ -161,6 +729,10 @@ class CacheProtocolResult(object):
         self.data = data
 
     def __str__(self):
+        if self.state is None:
+            # e.g. meta commands responding with a value have no terminating line
+            return str(self.data)
+
         representation = ""
         if self.data is not None:
             representation = str(self.data) + "\r\n"
@@ -177,9 +749,15 @@ class CacheProtocolCommand(object):
     # @todo [noreply] support
     supported_commands = [
         "get", "set", "stats", "incr", "decr", "delete", "add",
-        "replace", "append", "prepend", "flush_all"
+        "replace", "append", "prepend", "flush_all", "lget", "lset",
+        "mg", "ms", "md", "mn", "touch", "gat", "gats",
+        "ns_bump", "profile", "lru_crawler"
     ]
-    commands_which_send_data = ["set", "add", "replace", "append", "prepend"]
+    commands_which_send_data = ["set", "add", "replace", "append", "prepend", "lset", "ms"]
+    # position of <bytes> parameter of commands which send data, if it's not the 4th one
+    bytes_parameter_positions = {"ms": 1}
+    commands_with_multiple_keys = ["get", "gat", "gats"]
+    commands_without_keys = ["stats", "flush_all", "mn", "ns_bump", "profile", "lru_crawler"]
 
     def __init__(self, command, parameters, data=None):
         self.command = command
@@ -188,14 +766,33 @@ class CacheProtocolCommand(object):
         self.expected_bytes = None
 
         if self.command in self.commands_which_send_data:
-            if len(parameters) < 4:
-                raise AttributeError("At least 4 arguments required")
+            position = self.bytes_parameter_positions.get(self.command, 3)
+
+            if len(parameters) <= position:
+                raise AttributeError("At least {n} arguments required".format(n=position + 1))
 
             try:
-                self.expected_bytes = int(parameters[3])
+                self.expected_bytes = int(parameters[position])
             except ValueError:
                 raise ValueError("Number of bytes must be an integer")
 
+    def keys(self):
+        """
+        Keys the command operates on
+        :return: List of keys
+        """
+        if self.command in self.commands_without_keys:
+            return []
+
+        if self.command in self.commands_with_multiple_keys:
+            if self.command in ("gat", "gats"):
+                # first parameter is exptime
+                return self.parameters[1:]
+
+            return self.parameters
+
+        return self.parameters[:1]
+
     @staticmethod
     def process_command(command):
         tokens = command.split(" ")
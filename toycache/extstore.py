@@ -0,0 +1,245 @@
+import itertools
+import mmap
+import os
+
+
+class ExtStore(object):
+    """
+    Second storage tier for values which don't fit in memory: an append-only log of values split
+    in segment files, which are memory-mapped so that values can be read back without system
+    calls (the OS keeps hot pages in its page cache).
+
+    Values are never overwritten. Freed values leave holes which are reclaimed by compaction,
+    which moves live values of a mostly empty segment to the end of the log and removes
+    the segment.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, max_bytes=1024 * 1024 * 1024,
+                 compact_threshold=0.5):
+        """
+        :param directory: Existing directory to create segment files in
+        :param segment_size: Size of a segment file in bytes. Larger values get their own segment.
+        :param max_bytes: Maximum size of all segment files, values which don't fit are refused
+        :param compact_threshold: Segments with less than this fraction of live bytes are
+                                  compacted
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.compact_threshold = compact_threshold
+
+        self._segments = {}
+        self._segment_ids = itertools.count(1)
+        self._current = None
+
+        # segment being compacted and offsets of its values which haven't been moved yet
+        self._compacting = None
+        self._compact_offsets = []
+
+        # size of all segment files and of values still referenced
+        self.disk_bytes = 0
+        self.live_bytes = 0
+        self.compacted_bytes = 0
+
+    def write(self, data):
+        """
+        Append value to the log
+        :param data: String to store
+        :return: Pointer to the value, None if there is no space left
+        :rtype: ExtPointer
+        """
+        segment = self._current
+
+        if (segment is None) or (segment.used + len(data) > segment.size):
+            segment = self._new_segment(len(data))
+
+            if segment is None:
+                return None
+
+        offset = segment.used
+        segment.mmap[offset:offset + len(data)] = data
+        segment.used += len(data)
+
+        pointer = ExtPointer(segment, offset, len(data))
+        segment.pointers[offset] = pointer
+        segment.live += len(data)
+        self.live_bytes += len(data)
+
+        return pointer
+
+    def read(self, pointer, start=0, end=None):
+        """
+        Read value (or part of it) back
+        :type pointer: ExtPointer
+        :param start: Offset within the value to start at
+        :param end: Offset within the value to end at, end of the value if None
+        :return: String
+        """
+        segment, offset = pointer.location
+
+        if end is None:
+            end = pointer.length
+
+        return segment.mmap[offset + start:offset + end]
+
+    def free(self, pointer):
+        """
+        Mark value as no longer needed, its space is reclaimed later
+        :type pointer: ExtPointer
+        """
+        segment, offset = pointer.location
+
+        if segment.pointers.pop(offset, None) is None:
+            return
+
+        segment.live -= pointer.length
+        self.live_bytes -= pointer.length
+
+        if (segment.live == 0) and (segment is not self._current):
+            self._remove_segment(segment)
+
+    def compact(self, limit=1024 * 1024):
+        """
+        Move live values out of a mostly empty segment, at most `limit` bytes per call so that it
+        can run periodically without stalling other work. The segment is removed once empty.
+        :param limit: Maximum number of bytes to move
+        :return: Number of bytes moved
+        """
+        if self._compacting is None:
+            self._compacting = self._compaction_candidate()
+
+            if self._compacting is None:
+                return 0
+
+            self._compact_offsets = sorted(self._compacting.pointers.keys())
+
+        segment = self._compacting
+        moved = 0
+
+        while (moved < limit) and (len(self._compact_offsets) > 0):
+            pointer = segment.pointers.get(self._compact_offsets.pop())
+
+            if pointer is None:
+                # freed in the meantime
+                continue
+
+            if not self._move(pointer):
+                # no space left to move the value to, try again later
+                self._compact_offsets = []
+                break
+
+            moved += pointer.length
+
+        self.compacted_bytes += moved
+
+        if len(self._compact_offsets) == 0:
+            self._compacting = None
+
+            if (segment.live == 0) and (segment.id in self._segments):
+                self._remove_segment(segment)
+
+        return moved
+
+    def close(self):
+        """
+        Remove all segment files
+        """
+        for segment in list(self._segments.values()):
+            self._remove_segment(segment)
+
+        self._current = None
+
+    def _move(self, pointer):
+        segment, offset = pointer.location
+        data = self.read(pointer)
+
+        target = self._current
+        if (target is None) or (target is segment) or (target.used + len(data) > target.size):
+            target = self._new_segment(len(data))
+
+            if target is None:
+                return False
+
+        new_offset = target.used
+        target.mmap[new_offset:new_offset + len(data)] = data
+        target.used += len(data)
+        target.pointers[new_offset] = pointer
+        target.live += len(data)
+
+        del segment.pointers[offset]
+        segment.live -= len(data)
+
+        # single assignment, readers get either the old or the new location
+        pointer.location = (target, new_offset)
+
+        return True
+
+    def _compaction_candidate(self):
+        for segment in self._segments.values():
+            if segment is self._current:
+                continue
+
+            if segment.live < segment.used * self.compact_threshold:
+                return segment
+
+        return None
+
+    def _new_segment(self, min_size):
+        size = max(self.segment_size, min_size)
+
+        if self.disk_bytes + size > self.max_bytes:
+            return None
+
+        segment_id = next(self._segment_ids)
+        path = os.path.join(self.directory, "segment-{id}".format(id=segment_id))
+        segment = Segment(segment_id, path, size)
+
+        self._segments[segment_id] = segment
+        self.disk_bytes += size
+
+        previous, self._current = self._current, segment
+        if (previous is not None) and (previous.live == 0):
+            self._remove_segment(previous)
+
+        return segment
+
+    def _remove_segment(self, segment):
+        del self._segments[segment.id]
+        self.disk_bytes -= segment.size
+
+        if segment is self._current:
+            self._current = None
+
+        # the mapping is closed once nobody reads from it, e.g. a worker thread
+        os.remove(segment.path)
+
+
+class Segment(object):
+    """
+    Memory-mapped segment file of ExtStore.
+    """
+
+    def __init__(self, segment_id, path, size):
+        self.id = segment_id
+        self.path = path
+        self.size = size
+        # bytes written and bytes of values still referenced
+        self.used = 0
+        self.live = 0
+        # offset -> ExtPointer of live values
+        self.pointers = {}
+
+        with open(path, "w+b") as segment_file:
+            segment_file.truncate(size)
+            self.mmap = mmap.mmap(segment_file.fileno(), size)
+
+
+class ExtPointer(object):
+    """
+    Location of a value in ExtStore. Updated in place when compaction moves the value.
+    """
+
+    def __init__(self, segment, offset, length):
+        # (Segment, offset) tuple, replaced as a whole
+        self.location = (segment, offset)
+        self.length = length
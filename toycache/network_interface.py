@@ -1,10 +1,18 @@
+import socket
+
 from twisted.internet import reactor
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.internet.defer import Deferred, DeferredList
 from twisted.internet.protocol import Factory
 from twisted.protocols.basic import LineReceiver
 from twisted.application import service
 
-from toycache.cache import Cache
-from toycache.cache_interface import CacheProtocolCommand, CacheInterface
+from toycache.cache import Cache, ChunkedValue
+from toycache.cache_interface import CacheProtocolCommand, CacheInterface, CacheProtocolResult, \
+    StreamedData
+from toycache.extstore import ExtStore
+from toycache.offload import WorkerPool
+from toycache.trace import TraceWriter
 
 
 class CacheService(service.Service):
@@ -12,16 +20,139 @@ class CacheService(service.Service):
     Twisted Service used for running in application environment.
     """
 
-    def __init__(self, port_number=11222):
+    def __init__(self, port_number=11222, reclaim_interval=1, reclaim_batch=1000,
+                 reclaim_sweep_ratio=0.5, max_connections=1024, output_high_water=64 * 1024,
+                 unix_socket=None, unix_socket_mode=0o700, backlog=1024, tcp_nodelay=True,
+                 receive_buffer=None, send_buffer=None, offload_threads=2,
+                 offload_threshold=1024 * 1024, extstore_path=None,
+                 extstore_max_bytes=1024 * 1024 * 1024, compact_batch=1024 * 1024,
+                 trace_path=None, trace_sample_rate=1.0, trace_values="truncate"):
+        """
+        :param port_number: TCP port to listen on, None to not listen on TCP
+        :param reclaim_interval: How often (in seconds) memory of invalid items is reclaimed
+        :param reclaim_batch: Maximum number of keys checked per reclaim run
+        :param reclaim_sweep_ratio: While reclaim runs find at least this fraction of the batch
+                                    invalid (e.g. after flush_all or ns_bump), the next one is
+                                    scheduled for the next reactor turn instead of waiting
+                                    `reclaim_interval`. Items expiring one by one rarely add up to
+                                    it, so they don't keep the reactor busy.
+        :param max_connections: See CacheProtocolFactory
+        :param output_high_water: See CacheProtocolFactory
+        :param unix_socket: Path of Unix domain socket to listen on (in addition to TCP). It's
+                            guarded by a lock file, `<unix_socket>.lock`.
+        :param unix_socket_mode: Permissions of the Unix domain socket
+        :param backlog: Size of the listen backlog
+        :param tcp_nodelay: See CacheProtocolFactory
+        :param receive_buffer: Size of socket receive buffer (SO_RCVBUF), system default if None
+        :param send_buffer: Size of socket send buffer (SO_SNDBUF), system default if None
+        :param offload_threads: Number of worker threads for CPU heavy commands, 0 to run
+                                everything in the reactor thread
+        :param offload_threshold: See CacheInterface
+        :param extstore_path: Directory for the extstore segment files, values of items evicted
+                              from memory are dropped if None
+        :param extstore_max_bytes: Maximum size of the extstore on disk
+        :param compact_batch: Maximum number of bytes moved by a periodic extstore compaction
+        :param trace_path: File to record received commands to (see TraceWriter), nothing is
+                           recorded if None
+        :param trace_sample_rate: See TraceWriter
+        :param trace_values: See TraceWriter
+        """
         self.port_number = port_number
+        self.reclaim_interval = reclaim_interval
+        self.reclaim_batch = reclaim_batch
+        self.reclaim_sweep_ratio = reclaim_sweep_ratio
+        self.max_connections = max_connections
+        self.output_high_water = output_high_water
+        self.unix_socket = unix_socket
+        self.unix_socket_mode = unix_socket_mode
+        self.backlog = backlog
+        self.tcp_nodelay = tcp_nodelay
+        self.receive_buffer = receive_buffer
+        self.send_buffer = send_buffer
+        self.offload_threshold = offload_threshold
+        self.compact_batch = compact_batch
+        self.trace_path = trace_path
+        self.trace_sample_rate = trace_sample_rate
+        self.trace_values = trace_values
+        self.trace = None
+
+        extstore = None
+        if extstore_path is not None:
+            extstore = ExtStore(extstore_path, max_bytes=extstore_max_bytes)
+
+        self.cache = Cache(extstore=extstore)
+        self.ports = []
+
+        self.worker_pool = None
+        if offload_threads > 0:
+            self.worker_pool = WorkerPool(offload_threads)
 
     def startService(self):
-        self._port = reactor.listenTCP(self.port_number, CacheProtocolFactory())
+        if self.trace_path is not None:
+            self.trace = TraceWriter(
+                open(self.trace_path, "wb", 1024 * 1024), self.trace_sample_rate, self.trace_values
+            )
+
+        factory = CacheProtocolFactory(
+            self.cache, self.max_connections, self.output_high_water, self.tcp_nodelay,
+            self.worker_pool, self.offload_threshold, self.trace
+        )
+
+        if self.worker_pool is not None:
+            self.worker_pool.start()
+
+        if self.port_number is not None:
+            self.ports.append(reactor.listenTCP(self.port_number, factory, backlog=self.backlog))
+
+        if self.unix_socket is not None:
+            # the lock file lets the socket left over by a crashed server be removed on restart
+            self.ports.append(reactor.listenUNIX(
+                self.unix_socket, factory, backlog=self.backlog, mode=self.unix_socket_mode,
+                wantPID=True
+            ))
+
+        # accepted connections inherit buffer sizes of the listening socket
+        for port in self.ports:
+            if self.receive_buffer is not None:
+                port.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+            if self.send_buffer is not None:
+                port.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+
+        self._reclaim_call = reactor.callLater(self.reclaim_interval, self.reclaim)
 
     def stopService(self):
-        return self._port.stopListening()
+        if self._reclaim_call.active():
+            self._reclaim_call.cancel()
+
+        if self.worker_pool is not None:
+            self.worker_pool.stop()
+
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+        # values in the extstore are not usable after restart
+        if self.cache.extstore is not None:
+            self.cache.extstore.close()
+
+        ports, self.ports = self.ports, []
+
+        return DeferredList([port.stopListening() for port in ports])
+
+    def reclaim(self):
+        """
+        Reclaim one slice of invalid items and of extstore space and schedule the next run.
+        """
+        reclaimed = self.cache.reclaim(self.reclaim_batch)
+        compacted = self.cache.compact_extstore(self.compact_batch)
+
+        if (reclaimed >= self.reclaim_batch * self.reclaim_sweep_ratio) or (compacted > 0):
+            delay = 0
+        else:
+            delay = self.reclaim_interval
+
+        self._reclaim_call = reactor.callLater(delay, self.reclaim)
 
-# @todo support getting multiple keys in one request
 
 class CacheProtocol(LineReceiver):
     """
@@ -35,17 +166,68 @@ class CacheProtocol(LineReceiver):
     Memcached protocol docs say "There are two kinds of data sent in the memcache protocol:
     text lines and unstructured data." thus making LineReceiver a perfect choice as a helper
     parent class.
+
+    The protocol is registered as a streaming producer of its transport. When transport's write
+    buffer grows over the high-water mark, the protocol is paused, which stops reading commands
+    from the connection until the transport has drained the buffer. Results holding large (chunked)
+    values or lazily generated data (e.g. metadump) are streamed piece by piece, stopping
+    whenever the transport is full, so that the next piece is only generated once the client
+    has caught up. No further commands are read until the whole result is written.
+
+    Commands executed in a worker thread return a Deferred. Reading commands is paused until it
+    fires, so that responses are written in the order of commands.
     """
 
+    # set by CacheProtocolFactory, None if the protocol is used on its own (e.g. in benchmarks)
+    factory = None
+    # used to schedule generating the next piece of incremental results
+    clock = reactor
+
     def __init__(self, cache_interface):
         self.cache_interface = cache_interface
         self.state = "command"
         self.command_waiting_for_data = None
 
         self.data_bytes_remaining = 0
+        self.data_chunks = []
 
         self.processed_commands = list()
 
+        self._stream = None
+        self._stream_trailer = None
+        self._stream_incremental = False
+        self._stream_call = None
+        self._output_paused = False
+        self._waiting_for_result = False
+        self._accepted = False
+
+    def connectionMade(self):
+        if (self.factory is not None) and (not self.factory.connection_opened()):
+            self.transport.write("SERVER_ERROR too many open connections\r\n")
+            self.transport.loseConnection()
+            return
+
+        self._accepted = True
+
+        # only TCP connections have Nagle's algorithm to disable
+        is_tcp = isinstance(self.transport.getHost(), (IPv4Address, IPv6Address)) and \
+                 hasattr(self.transport, "setTcpNoDelay")
+
+        if (self.factory is not None) and self.factory.tcp_nodelay and is_tcp:
+            self.transport.setTcpNoDelay(True)
+
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        if self._accepted and (self.factory is not None):
+            if self._output_paused:
+                self.factory.stats.paused_connections -= 1
+
+            self.factory.connection_closed()
+
+        self._accepted = False
+        self._stop_stream()
+
     def lineReceived(self, line):
         if len(line) == 0:
             return
@@ -59,7 +241,8 @@ class CacheProtocol(LineReceiver):
             return
 
         if command.command in CacheProtocolCommand.commands_which_send_data:
-            self.data_bytes_remaining = command.expected_bytes
+            # data block is terminated by \r\n
+            self.data_bytes_remaining = command.expected_bytes + 2
             self.command_waiting_for_data = command
             self.state = "data"
             self.setRawMode()
@@ -67,60 +250,233 @@ class CacheProtocol(LineReceiver):
             self.processed_commands.append(command)
 
         if self.state != "data":
-            result = self.cache_interface.execute(command)
-            self.write_result(result)
+            self.execute(command)
 
     def rawDataReceived(self, data):
         if self.data_bytes_remaining == 0:
             raise ValueError("No data expected")
 
-        bytes_received = len(data)
+        # collect received pieces and join them once, concatenating on every read is quadratic
+        self.data_chunks.append(data)
+        self.data_bytes_remaining -= len(data)
 
-        if (bytes_received == (self.data_bytes_remaining + 2)) and data[-2:] == "\r\n":
-            # remove terminating \r\n sequence
-            data = data.rstrip()
-            bytes_received -= 2
+        if self.data_bytes_remaining > 0:
+            return
 
-        if bytes_received > self.data_bytes_remaining:
-            self.write_result("CLIENT_ERROR bad data chunk")
+        command = self.command_waiting_for_data
+        received = "".join(self.data_chunks)
 
-            # reset state
-            self.state = "command"
-            self.setLineMode()
-            self.command_waiting_for_data = None
+        data_length = command.expected_bytes
+        terminator = received[data_length:data_length + 2]
+        # anything after the data block belongs to the next (pipelined) commands
+        extra = received[data_length + 2:]
 
-        if self.state == "command":
-            return
+        self.state = "command"
+        self.command_waiting_for_data = None
+        self.data_chunks = []
+        self.data_bytes_remaining = 0
 
-        if self.command_waiting_for_data is None:
+        if terminator != "\r\n":
+            self.write_result("CLIENT_ERROR bad data chunk")
+            self.setLineMode(extra)
             return
 
-        if self.command_waiting_for_data.data is None:
-            self.command_waiting_for_data.data = ""
+        command.data = received[:data_length]
+        self.processed_commands.append(command)
 
-        self.command_waiting_for_data.data += data
-        self.data_bytes_remaining -= bytes_received
+        self.execute(command)
 
-        if self.data_bytes_remaining == 0:
-            self.state = "command"
-            self.setLineMode()
+        self.setLineMode(extra)
 
-            command = self.command_waiting_for_data
-            self.command_waiting_for_data = None
+    def execute(self, command):
+        if (self.factory is not None) and (self.factory.trace is not None):
+            self.factory.trace.record(command)
 
-            self.processed_commands.append(command)
+        result = self.cache_interface.execute(command)
 
-            result = self.cache_interface.execute(command)
+        if isinstance(result, Deferred):
+            self.wait_for_result(result)
+        else:
             self.write_result(result)
 
+    def wait_for_result(self, deferred):
+        """
+        Stop reading commands until the deferred result is ready and write it.
+        :type deferred: Deferred
+        """
+        self._waiting_for_result = True
+        LineReceiver.pauseProducing(self)
+
+        deferred.addErrback(self._result_failed)
+        deferred.addCallback(self._result_ready)
+
+    def _result_failed(self, failure):
+        return CacheProtocolResult("SERVER_ERROR {error}".format(error=failure.getErrorMessage()))
+
+    def _result_ready(self, result):
+        self._waiting_for_result = False
+        self.write_result(result)
+
+        if (self._stream is None) and (not self._output_paused):
+            LineReceiver.resumeProducing(self)
+
     def write_result(self, result):
+        if result is None:
+            # quiet mode, nothing to respond with
+            return
+
+        if isinstance(result, CacheProtocolResult) and \
+                isinstance(result.data, (ChunkedValue, StreamedData)):
+            self.stream_result(result)
+            return
+
         printable_result = str(result)
         self.sendLine(printable_result)
+        self._pause_if_output_full()
+
+    def stream_result(self, result):
+        """
+        Write result chunk by chunk, respecting transport's backpressure.
+        :type result: CacheProtocolResult
+        """
+        self._stream = iter(result.data)
+        self._stream_incremental = isinstance(result.data, StreamedData) and \
+                                   result.data.incremental
+        if result.state is None:
+            self._stream_trailer = self.delimiter
+        else:
+            self._stream_trailer = "\r\n" + str(result.state) + self.delimiter
+
+        # stop reading commands until the result is fully written
+        LineReceiver.pauseProducing(self)
+        self._write_stream()
+
+    def _write_stream(self):
+        self._stream_call = None
+
+        while (self._stream is not None) and (not self._output_paused):
+            try:
+                chunk = next(self._stream)
+            except StopIteration:
+                self.transport.write(self._stream_trailer)
+                self._stream = None
+                LineReceiver.resumeProducing(self)
+                return
+
+            self.transport.write(chunk)
+            self._pause_if_output_full()
+
+            if self._stream_incremental and (not self._output_paused):
+                # let the reactor serve other connections before the next step of the work
+                self._stream_call = self.clock.callLater(0, self._write_stream)
+                return
+
+    def _stop_stream(self):
+        self._stream = None
+
+        if self._stream_call is not None:
+            self._stream_call.cancel()
+            self._stream_call = None
+
+    def _pause_if_output_full(self):
+        """
+        Pause when connection's pending output is over the high-water mark. Twisted's transports
+        pause their producer once the output exceeds their `bufferSize`, but that is also
+        the size of their reads, so it is left alone and the output is measured here instead.
+        """
+        transport = self.transport
+
+        if (self.factory is None) or self._output_paused or \
+                (not hasattr(transport, "_tempDataLen")):
+            return
+
+        pending = len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+
+        if pending > self.factory.output_high_water:
+            # the transport resumes its paused producer once the output has been written
+            transport.producerPaused = True
+            self.pauseProducing()
+
+    def pauseProducing(self):
+        # called by the transport when its write buffer is full
+        if (not self._output_paused) and (self.factory is not None):
+            self.factory.stats.paused_connections += 1
+
+        self._output_paused = True
+        LineReceiver.pauseProducing(self)
+
+    def resumeProducing(self):
+        # called by the transport when its write buffer has been drained
+        if self._output_paused and (self.factory is not None):
+            self.factory.stats.paused_connections -= 1
+
+        self._output_paused = False
+
+        if self._stream is not None:
+            # reading is resumed once the whole result is written
+            if self._stream_call is None:
+                self._write_stream()
+        elif not self._waiting_for_result:
+            LineReceiver.resumeProducing(self)
+
+    def stopProducing(self):
+        self._stop_stream()
+        LineReceiver.stopProducing(self)
 
 
 class CacheProtocolFactory(Factory):
-    def __init__(self):
-        self.cache_interface = CacheInterface(Cache())
+    def __init__(self, cache=None, max_connections=None, output_high_water=64 * 1024,
+                 tcp_nodelay=True, worker_pool=None, offload_threshold=1024 * 1024,
+                 trace=None):
+        """
+        :param cache: Cache to serve, new one is created if not given
+        :param max_connections: Maximum number of open connections, further connections are
+                                rejected. None for no limit.
+        :param output_high_water: Size (in bytes) of connection's pending output at which reading
+                                  from the connection is paused. Twisted's transports also pause
+                                  at their own `bufferSize` (64KB), so higher values only take
+                                  effect up to it.
+        :param tcp_nodelay: Disable Nagle's algorithm on TCP connections, so that small
+                            responses are sent right away
+        :param worker_pool: See CacheInterface
+        :param offload_threshold: See CacheInterface
+        :type trace: toycache.trace.TraceWriter
+        :param trace: Trace to record received commands to
+        """
+        if cache is None:
+            cache = Cache()
+
+        self.cache_interface = CacheInterface(
+            cache, worker_pool=worker_pool, offload_threshold=offload_threshold
+        )
+        self.stats = cache.stats
+        self.max_connections = max_connections
+        self.output_high_water = output_high_water
+        self.tcp_nodelay = tcp_nodelay
+        self.trace = trace
 
     def buildProtocol(self, addr):
-        return CacheProtocol(self.cache_interface)
+        protocol = CacheProtocol(self.cache_interface)
+        protocol.factory = self
+
+        return protocol
+
+    def connection_opened(self):
+        """
+        Account for a new connection
+        :return: True if the connection is accepted, False if it has to be rejected
+        """
+        limit_reached = (self.max_connections is not None) and \
+                        (self.stats.curr_connections >= self.max_connections)
+
+        if limit_reached:
+            self.stats.rejected_connections += 1
+            return False
+
+        self.stats.curr_connections += 1
+        self.stats.total_connections += 1
+
+        return True
+
+    def connection_closed(self):
+        self.stats.curr_connections -= 1
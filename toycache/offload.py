@@ -0,0 +1,142 @@
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+
+class WorkerPool(object):
+    """
+    Bounded pool of worker threads for CPU heavy work, so that it doesn't block the reactor.
+
+    Work is submitted per key. Operations on the same key (whether they run in a thread or not)
+    are executed one at a time in submission order, which keeps results consistent: e.g. a get
+    issued after an offloaded append sees the appended value.
+    """
+
+    def __init__(self, max_threads=2, run_in_thread=None):
+        """
+        :param max_threads: Maximum number of worker threads
+        :param run_in_thread: Callable (function, *args) -> Deferred running the function in
+                              a thread. Defaults to the pool's own thread pool, can be overridden
+                              e.g. in tests.
+        """
+        self._threadpool = None
+
+        if run_in_thread is None:
+            self._threadpool = ThreadPool(0, max_threads, "toycache-offload")
+            run_in_thread = self._defer_to_threadpool
+
+        self._run_in_thread = run_in_thread
+        # key -> queue of operations on the key, the first one is running (or about to)
+        self._queues = {}
+
+        # number of functions submitted to threads which haven't finished yet
+        self.queue_depth = 0
+        # number of operations waiting for other operations on the same keys
+        self.waiting = 0
+        self.completed = 0
+
+    def start(self):
+        if self._threadpool is not None:
+            self._threadpool.start()
+
+    def stop(self):
+        if self._threadpool is not None:
+            self._threadpool.stop()
+
+    def busy(self, keys):
+        """
+        Check if there are operations running or waiting for any of the given keys
+        :param keys: List of keys
+        """
+        for key in keys:
+            if key in self._queues:
+                return True
+
+        return False
+
+    def run(self, keys, function):
+        """
+        Run the function on the reactor thread once all operations previously submitted for any of
+        the keys are done. The function can offload work using `defer_to_thread` and return
+        the Deferred.
+        :param keys: List of keys the operation works with
+        :param function: Callable without arguments
+        :return: Deferred firing with the result of the function
+        """
+        operation = KeyedOperation(keys, function)
+
+        for key in keys:
+            self._queues.setdefault(key, deque()).append(operation)
+
+        self.waiting += 1
+        self._start_if_ready(operation)
+
+        return operation.deferred
+
+    def defer_to_thread(self, function, *args):
+        """
+        Run the function in a worker thread
+        :return: Deferred firing with the result of the function
+        """
+        self.queue_depth += 1
+
+        deferred = self._run_in_thread(function, *args)
+        deferred.addBoth(self._thread_finished)
+
+        return deferred
+
+    def _defer_to_threadpool(self, function, *args):
+        return deferToThreadPool(reactor, self._threadpool, function, *args)
+
+    def _thread_finished(self, result):
+        self.queue_depth -= 1
+        self.completed += 1
+
+        return result
+
+    def _start_if_ready(self, operation):
+        if operation.started:
+            return
+
+        for key in operation.keys:
+            if self._queues[key][0] is not operation:
+                return
+
+        operation.started = True
+        self.waiting -= 1
+
+        deferred = maybeDeferred(operation.function)
+        deferred.addBoth(self._operation_finished, operation)
+
+    def _operation_finished(self, result, operation):
+        for key in operation.keys:
+            queue = self._queues[key]
+            queue.popleft()
+
+            if len(queue) == 0:
+                del self._queues[key]
+
+        if isinstance(result, Failure):
+            operation.deferred.errback(result)
+        else:
+            operation.deferred.callback(result)
+
+        for key in operation.keys:
+            if key in self._queues:
+                self._start_if_ready(self._queues[key][0])
+
+
+class KeyedOperation(object):
+    """
+    Operation submitted to WorkerPool
+    """
+
+    def __init__(self, keys, function):
+        self.keys = keys
+        self.function = function
+        self.deferred = Deferred()
+        self.started = False
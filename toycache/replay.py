@@ -0,0 +1,197 @@
+"""
+Replays a trace recorded by CacheService (see toycache.trace) against a new Cache or a running
+server and reports hit ratio and latency.
+
+Usage: python -m toycache.replay <trace file> [--speed SPEED] [--server HOST:PORT]
+                                 [--max-items N]
+"""
+import argparse
+import socket
+import time
+import timeit
+
+from toycache.cache import Cache, ChunkedValue, ClientError, ServerError
+from toycache.cache_interface import CacheInterface, CacheProtocolResult, StreamedData
+from toycache.trace import TraceReader
+
+
+error_responses = ("CLIENT_ERROR", "SERVER_ERROR", "ERROR")
+
+
+def replay(records, target, speed=0, timer=timeit.default_timer, sleep=time.sleep):
+    """
+    Execute traced commands against the target
+    :param records: Iterable of TraceRecord
+    :param target: CacheTarget or ServerTarget
+    :param speed: 1 keeps the original timing of commands, 2 replays twice as fast etc. 0 replays
+                  the commands one after another as fast as possible.
+    :return: List of latencies in seconds. With speed set, latency of a command is measured from
+             the time it was due, i.e. it includes waiting for commands before it.
+    """
+    latencies = []
+    started_at = None
+    first_timestamp = None
+
+    for record in records:
+        command = record.command()
+
+        if command is None:
+            continue
+
+        now = timer()
+
+        if started_at is None:
+            started_at = now
+            first_timestamp = record.timestamp
+
+        if speed > 0:
+            due = started_at + (record.timestamp - first_timestamp) / speed
+
+            if due > now:
+                sleep(due - now)
+        else:
+            due = now
+
+        target.execute(command)
+        latencies.append(timer() - due)
+
+    return latencies
+
+
+class CacheTarget(object):
+    """
+    Replays commands directly against a Cache.
+    """
+
+    def __init__(self, cache):
+        """
+        :type cache: Cache
+        """
+        self.cache = cache
+        self.cache_interface = CacheInterface(cache)
+        self.errors = 0
+
+    def execute(self, command):
+        try:
+            result = self.cache_interface.execute(command)
+        except (ClientError, ServerError):
+            self.errors += 1
+            return
+
+        if not isinstance(result, CacheProtocolResult):
+            return
+
+        if str(result.state).startswith(error_responses):
+            self.errors += 1
+
+        if isinstance(result.data, (ChunkedValue, StreamedData)):
+            # generate streamed results in full, like the network interface would
+            for _ in result.data:
+                pass
+
+    def stats(self):
+        return {"get_hits": self.cache.stats.get_hits, "get_misses": self.cache.stats.get_misses}
+
+
+class ServerTarget(object):
+    """
+    Replays commands against a running server over a single connection.
+
+    Every command is followed by `mn`, so that the end of any response (including quiet meta
+    commands, which may not respond at all) is recognized by the `MN` which follows it.
+    """
+
+    def __init__(self, host, port):
+        self.connection = socket.create_connection((host, port))
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.errors = 0
+
+    def execute(self, command):
+        request = " ".join([command.command] + command.parameters) + "\r\n"
+
+        if command.data is not None:
+            request += command.data + "\r\n"
+
+        self.connection.sendall(request + "mn\r\n")
+        response = self._read_until("MN\r\n")
+
+        if response.startswith(error_responses):
+            self.errors += 1
+
+    def stats(self):
+        self.connection.sendall("stats\r\n")
+        response = self._read_until("END\r\n")
+
+        stats = {}
+        for line in response.split("\r\n"):
+            tokens = line.split(" ")
+
+            if (len(tokens) == 3) and (tokens[1] in ("get_hits", "get_misses")):
+                stats[tokens[1]] = int(tokens[2])
+
+        return stats
+
+    def _read_until(self, terminator):
+        response = ""
+
+        while not response.endswith(terminator):
+            data = self.connection.recv(64 * 1024)
+
+            if len(data) == 0:
+                raise IOError("Connection closed by the server")
+
+            response += data
+
+        return response
+
+
+def percentile(latencies, p):
+    return latencies[min(int(len(latencies) * p / 100.0), len(latencies) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a toycache trace")
+    parser.add_argument("trace", help="Trace file recorded with trace_path")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="1 for the original speed, 2 for twice as fast, 0 (default) for as "
+                             "fast as possible")
+    parser.add_argument("--server", help="HOST:PORT of a server to replay against, a new cache "
+                                         "is created in-process if not given")
+    parser.add_argument("--max-items", type=int, default=10000,
+                        help="max_items of the in-process cache")
+    args = parser.parse_args()
+
+    if args.server is not None:
+        host, port = args.server.rsplit(":", 1)
+        target = ServerTarget(host, int(port))
+    else:
+        target = CacheTarget(Cache(max_items=args.max_items))
+
+    stats_before = target.stats()
+
+    with open(args.trace, "rb") as trace_file:
+        started_at = timeit.default_timer()
+        latencies = sorted(replay(TraceReader(trace_file), target, args.speed))
+        elapsed = timeit.default_timer() - started_at
+
+    stats = target.stats()
+    hits = stats["get_hits"] - stats_before["get_hits"]
+    misses = stats["get_misses"] - stats_before["get_misses"]
+
+    print("commands {count}  errors {errors}  {rate:.0f} commands/s".format(
+        count=len(latencies), errors=target.errors, rate=len(latencies) / max(elapsed, 1e-9)
+    ))
+    print("hit ratio {ratio:.4f} ({hits} hits, {misses} misses)".format(
+        ratio=float(hits) / max(hits + misses, 1), hits=hits, misses=misses
+    ))
+
+    if len(latencies) > 0:
+        print("latency p50 {p50:.1f}us  p99 {p99:.1f}us  max {max:.1f}us".format(
+            p50=percentile(latencies, 50) * 1e6,
+            p99=percentile(latencies, 99) * 1e6,
+            max=latencies[-1] * 1e6
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import hashlib
+import struct
+import time
+import zlib
+
+from toycache.cache_interface import CacheProtocolCommand
+
+
+class TraceWriter(object):
+    """
+    Records received commands to a compact binary trace file, which can be replayed later
+    (see toycache.replay).
+
+    The file starts with `magic`, followed by a record per command: `record_header` (timestamp,
+    length of the command line, size of the data block or -1 if the command has none, length of
+    the stored data), the command line and the stored data. Data blocks are not stored in full,
+    only their first bytes or a hash, which keeps the trace small and doesn't leak the values;
+    the replay fills them up to the original size.
+    """
+
+    magic = "TOYCACHE TRACE 1\n"
+    record_header = struct.Struct("<dIiI")
+    value_modes = ["truncate", "hash"]
+
+    def __init__(self, trace_file, sample_rate=1.0, values="truncate", value_bytes=16,
+                 timer=time.time):
+        """
+        :param trace_file: File object opened for writing in binary mode
+        :param sample_rate: Fraction of keys to record commands of. Keys are sampled by their
+                            hash, so that all commands on a sampled key are recorded (multi-key
+                            commands are sampled by the first key). Commands without keys are
+                            always recorded.
+        :param values: How data blocks are stored: "truncate" keeps the first `value_bytes`
+                       bytes, "hash" keeps a hash of the data instead
+        :param value_bytes: Number of bytes of data blocks kept by "truncate"
+        :param timer: Callable returning current time in seconds
+        """
+        if values not in self.value_modes:
+            raise ValueError("Unknown value mode {values}".format(values=values))
+
+        self._file = trace_file
+        self._sample_below = int(sample_rate * 2 ** 32)
+        self._hash_values = values == "hash"
+        self._value_bytes = value_bytes
+        self._timer = timer
+
+        self.recorded = 0
+        self.skipped = 0
+
+        self._file.write(self.magic)
+
+    def record(self, command):
+        """
+        Write command to the trace, unless its key is not sampled
+        :type command: CacheProtocolCommand
+        """
+        keys = command.keys()
+
+        if (len(keys) > 0) and ((zlib.crc32(keys[0]) & 0xffffffff) >= self._sample_below):
+            self.skipped += 1
+            return
+
+        line = " ".join([command.command] + command.parameters)
+
+        if command.data is None:
+            size = -1
+            stored = ""
+        elif self._hash_values:
+            size = len(command.data)
+            stored = hashlib.sha1(command.data).digest()[:8]
+        else:
+            size = len(command.data)
+            stored = command.data[:self._value_bytes]
+
+        self._file.write(
+            self.record_header.pack(self._timer(), len(line), size, len(stored)) + line + stored
+        )
+        self.recorded += 1
+
+    def close(self):
+        self._file.close()
+
+
+class TraceReader(object):
+    """
+    Reads records of a trace written by TraceWriter.
+    """
+
+    def __init__(self, trace_file):
+        """
+        :param trace_file: File object opened for reading in binary mode
+        """
+        if trace_file.read(len(TraceWriter.magic)) != TraceWriter.magic:
+            raise ValueError("Not a trace file")
+
+        self._file = trace_file
+
+    def __iter__(self):
+        header = TraceWriter.record_header
+
+        while True:
+            data = self._file.read(header.size)
+
+            if len(data) < header.size:
+                return
+
+            timestamp, line_length, data_size, stored_length = header.unpack(data)
+            line = self._file.read(line_length)
+            stored = self._file.read(stored_length)
+
+            yield TraceRecord(timestamp, line, data_size, stored)
+
+
+class TraceRecord(object):
+    """
+    Command read from a trace.
+    """
+
+    def __init__(self, timestamp, line, data_size, data):
+        """
+        :param timestamp: Time the command was received at
+        :param line: Command line
+        :param data_size: Size of the original data block, -1 if the command has none
+        :param data: Stored part (or hash) of the data block
+        """
+        self.timestamp = timestamp
+        self.line = line
+        self.data_size = data_size
+        self.data = data
+
+    def command(self):
+        """
+        Build command to replay, the data block is filled up to its original size
+        :return: CacheProtocolCommand, None if the line is not a valid command
+        """
+        command = CacheProtocolCommand.process_command(self.line)
+
+        if (command is not None) and (self.data_size >= 0):
+            data = self.data[:self.data_size]
+            command.data = data + "x" * (self.data_size - len(data))
+
+        return command